@@ -0,0 +1,449 @@
+""" Benchmark the env, data pipeline and models, and detect regressions """
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, List, Tuple
+
+import gym
+import numpy as np
+import torch
+from gym_super_mario_bros.actions import SIMPLE_MOVEMENT
+from nes_py.nes_env import SCREEN_HEIGHT, SCREEN_WIDTH
+
+import lib.env
+import lib.model_ml
+import lib.utils
+from lib.import_budget import IMPORT_BUDGET_MS, import_time
+
+SYNTHETIC_ENV_ID = "SyntheticMario-v0"
+
+
+class SyntheticMarioEnv(gym.Env):
+    """A stand-in for the emulator, scrolling a random background.
+
+    It has the observation and action spaces of SuperMarioBrosEnv and costs
+    next to nothing to step, so that the benchmarks measure the wrappers, the
+    frame stacking and the models rather than the emulation.
+    """
+
+    metadata = {"render.modes": ["rgb_array"]}
+
+    def __init__(self, episode_steps: int = 1000) -> None:
+        """
+        Args:
+            episode_steps : number of steps of an episode
+        """
+        self.observation_space = gym.spaces.Box(
+            0, 255, (SCREEN_HEIGHT, SCREEN_WIDTH, 3), dtype=np.uint8
+        )
+        self.action_space = gym.spaces.Discrete(256)
+        self.episode_steps = episode_steps
+        self.background = np.random.default_rng(0).integers(
+            0, 256, (SCREEN_HEIGHT, 2 * SCREEN_WIDTH, 3), dtype=np.uint8
+        )
+        self.t = 0
+
+    def _frame(self) -> np.array:
+        offset = self.t % SCREEN_WIDTH
+        return self.background[:, offset : offset + SCREEN_WIDTH].copy()
+
+    def seed(self, seed=None):
+        """The frames do not depend on the seed."""
+        return [seed]
+
+    def reset(self) -> np.array:
+        """Scroll back to the start of the background."""
+        self.t = 0
+        return self._frame()
+
+    def step(self, _action: int):
+        """Scroll the background by a pixel, whatever the action."""
+        self.t += 1
+        done = self.t >= self.episode_steps
+        return self._frame(), 0.0, done, {"x_pos": self.t, "flag_get": False}
+
+
+def register_synthetic_env() -> None:
+    """Register SyntheticMarioEnv, in each process that creates it."""
+    if SYNTHETIC_ENV_ID not in gym.envs.registry.env_specs:
+        gym.envs.registration.register(
+            id=SYNTHETIC_ENV_ID, entry_point=SyntheticMarioEnv
+        )
+
+
+def peak_memory_mb() -> float:
+    """Get the peak memory (resident set size) of the process in MB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def bench_env_unstacked(config: dict, n_steps: int) -> dict:
+    """Time the steps of create_unstacked_env.
+
+    Args:
+        config : config parameters of the RL training
+        n_steps : number of timed steps
+
+    Returns:
+        The steps/sec
+    """
+    register_synthetic_env()
+    env = lib.env.create_unstacked_env(
+        SYNTHETIC_ENV_ID, **lib.env.preprocessing_from_config(config)
+    )
+    env.reset()
+    actions = np.random.default_rng(0).integers(len(SIMPLE_MOVEMENT), size=n_steps)
+    start = time.perf_counter()
+    for action in actions:
+        _, _, done, _ = env.step(int(action))
+        if done:
+            env.reset()
+    elapsed = time.perf_counter() - start
+    env.close()
+    return {"steps_per_sec": n_steps / elapsed}
+
+
+def bench_env_stacked(config: dict, n_steps: int) -> dict:
+    """Time the vectorized steps of create_stacked_env, see bench_env_unstacked
+
+    The emulators are stepped in this process, the synthetic env not being
+    registered in the worker processes of a SubprocVecEnv.
+    """
+    register_synthetic_env()
+    n_envs = config.get("n_envs", 1)
+    env = lib.env.create_stacked_env(
+        config["stacks"],
+        n_envs,
+        "dummy",
+        env_id=SYNTHETIC_ENV_ID,
+        **lib.env.preprocessing_from_config(config),
+    )
+    env.reset()
+    actions = np.random.default_rng(0).integers(
+        len(SIMPLE_MOVEMENT), size=(n_steps, n_envs)
+    )
+    start = time.perf_counter()
+    for action in actions:
+        env.step(action)
+    elapsed = time.perf_counter() - start
+    env.close()
+    return {"steps_per_sec": n_steps * n_envs / elapsed}
+
+
+def write_synthetic_sessions(path: str, n_runs: int, run_steps: int) -> None:
+    """Write human runs of synthetic frames in the chunked format.
+
+    Args:
+        path : directory of the runs
+        n_runs : number of runs
+        run_steps : number of steps of each run
+    """
+    register_synthetic_env()
+    env = lib.env.create_unstacked_env(SYNTHETIC_ENV_ID)
+    rng = np.random.default_rng(0)
+    for run in range(n_runs):
+        run_path = os.path.join(path, f"run_{run}")
+        os.makedirs(run_path)
+        state = env.reset()
+        states, actions = [], []
+        for _ in range(run_steps):
+            action = int(rng.integers(len(SIMPLE_MOVEMENT)))
+            states.append(state)
+            actions.append(action)
+            state, _, done, _ = env.step(action)
+            if done:
+                state = env.reset()
+        for index, start in enumerate(range(0, run_steps, 1024)):
+            lib.utils.write_chunk(
+                run_path,
+                index,
+                states[start : start + 1024],
+                actions[start : start + 1024],
+            )
+    env.close()
+
+
+def bench_data(config: dict, n_runs: int, run_steps: int) -> dict:
+    """Time load_human_data and transform_data, then an epoch of the train data
+
+    Args:
+        config : config parameters of the ML training
+        n_runs : number of synthetic runs
+        run_steps : number of steps of each run
+
+    Returns:
+        The loading time, including the caching of the preprocessed dataset,
+        the samples/sec of the train loader and the peak memory
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        data_path = os.path.join(tmp, "human")
+        write_synthetic_sessions(data_path, n_runs, run_steps)
+        config = {**config, "cache_path": os.path.join(tmp, "cache")}
+
+        start = time.perf_counter()
+        data = lib.utils.load_human_data(data_path)
+        train_loader, _ = lib.utils.transform_data(data, config)
+        load_sec = time.perf_counter() - start
+
+        samples = 0
+        start = time.perf_counter()
+        for _, labels in train_loader:
+            samples += len(labels)
+        elapsed = time.perf_counter() - start
+
+        return {
+            "load_sec": load_sec,
+            "samples_per_sec": samples / elapsed,
+            "peak_memory_mb": peak_memory_mb(),
+        }
+
+
+def create_model(config: dict) -> lib.model_ml.PolicyModel:
+    """Create the ML model of a config for its observations
+
+    Args:
+        config : config parameters of the ML training
+
+    Returns:
+        The model
+    """
+    height, width, stacks = lib.env.observation_shape(config)
+    return lib.model_ml.create_model(
+        config, len(SIMPLE_MOVEMENT), (stacks, height, width)
+    )
+
+
+def bench_model(config: dict, batch_sizes: List[int], n_reps: int) -> dict:
+    """Time the forward and predict of the ML model per batch size
+
+    Args:
+        config : config parameters of the ML training
+        batch_sizes : the batch sizes
+        n_reps : number of timed calls per batch size, after a warm-up one
+
+    Returns:
+        The latency of a call in ms for each batch size
+    """
+    height, width, stacks = lib.env.observation_shape(config)
+    model = create_model(config)
+    model.eval()
+    results = {}
+    for batch_size in batch_sizes:
+        images = torch.rand(batch_size, 1, stacks, height, width)
+        states = np.random.default_rng(0).integers(
+            0, 256, (batch_size, height, width, stacks), dtype=np.uint8
+        )
+        with torch.inference_mode():
+            model(images)
+            start = time.perf_counter()
+            for _ in range(n_reps):
+                model(images)
+            forward_ms = (time.perf_counter() - start) / n_reps * 1e3
+        model.predict(states)
+        start = time.perf_counter()
+        for _ in range(n_reps):
+            model.predict(states)
+        predict_ms = (time.perf_counter() - start) / n_reps * 1e3
+        results[f"forward_ms_b{batch_size}"] = forward_ms
+        results[f"predict_ms_b{batch_size}"] = predict_ms
+    return results
+
+
+def bench_learn(config: dict, n_batches: int) -> dict:
+    """Time lib.model_ml.learn over an epoch of random batches
+
+    Args:
+        config : config parameters of the ML training
+        n_batches : number of batches of the epoch
+
+    Returns:
+        The samples/sec of the epoch, evaluation excluded, and the peak memory
+    """
+    height, width, stacks = lib.env.observation_shape(config)
+    batch_size = config["batch_size"]
+    generator = torch.Generator().manual_seed(0)
+    images = torch.rand(
+        n_batches * batch_size, 1, stacks, height, width, generator=generator
+    )
+    labels = torch.randint(
+        len(SIMPLE_MOVEMENT), (n_batches * batch_size,), generator=generator
+    )
+    dataset = torch.utils.data.TensorDataset(images, labels)
+    train_loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size)
+    test_loader = torch.utils.data.DataLoader(
+        torch.utils.data.Subset(dataset, range(batch_size)), batch_size=batch_size
+    )
+    config = {**config, "n_iters": 1, "eval_schedule": "epoch", "eval_samples": 0}
+    _, metrics = lib.model_ml.learn(
+        create_model(config), train_loader, test_loader, config
+    )
+    return {
+        "samples_per_sec": metrics["samples_per_sec"].iloc[0],
+        "peak_memory_mb": peak_memory_mb(),
+    }
+
+
+def bench_imports(modules: List[str], n_reps: int) -> dict:
+    """Time the imports of the entry points, the best of `n_reps` runs.
+
+    Args:
+        modules : names of the modules
+        n_reps : number of fresh interpreters per module
+
+    Returns:
+        The import time of each module and the number of heavy modules it
+        imports, see lib.import_budget
+    """
+    results = {}
+    for module in modules:
+        times, heavy = zip(*(import_time(module) for _ in range(n_reps)))
+        results[f"{module}_ms"] = min(times)
+        results[f"{module}_heavy_modules"] = len(heavy[0])
+        if heavy[0]:
+            print(f"[INFO] {module} imports {' '.join(heavy[0])}")
+    return results
+
+
+def benchmarks(
+    config_rl: dict, config_ml: dict
+) -> Dict[str, Tuple[Callable[..., dict], tuple]]:
+    """The benchmarks of the suite, by name.
+
+    Args:
+        config_rl : config parameters of the RL training
+        config_ml : config parameters of the ML training
+
+    Returns:
+        The benchmark functions and their arguments
+    """
+    return {
+        "env_unstacked": (bench_env_unstacked, (config_rl, 2000)),
+        "env_stacked": (bench_env_stacked, (config_rl, 2000)),
+        "data": (bench_data, (config_ml, 4, 2048)),
+        "model": (bench_model, (config_ml, [1, 8, 32, 128], 20)),
+        "learn": (bench_learn, (config_ml, 20)),
+        "imports": (bench_imports, (list(IMPORT_BUDGET_MS), 3)),
+    }
+
+
+def is_regression(metric: str, value: float, baseline: float, threshold: float) -> bool:
+    """Whether a metric regressed beyond a relative threshold.
+
+    Metrics ending with _per_sec are higher is better, the others (durations
+    and memory) lower is better.
+
+    Args:
+        metric : name of the metric
+        value : its value
+        baseline : its value in the baseline
+        threshold : relative change tolerated, e.g. 0.1 for 10%
+
+    Returns:
+        Whether the metric regressed
+    """
+    if not baseline:
+        return False
+    change = (value - baseline) / baseline
+    if metric.endswith("_per_sec"):
+        return change < -threshold
+    return change > threshold
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> List[str]:
+    """Compare the results of a run to a baseline run.
+
+    Args:
+        results : the results of the run
+        baseline : the results of the baseline run
+        threshold : relative change tolerated, see is_regression
+
+    Returns:
+        The descriptions of the regressions
+    """
+    regressions = []
+    for name, metrics in results["results"].items():
+        for metric, value in metrics.items():
+            base = baseline["results"].get(name, {}).get(metric)
+            if base is None:
+                continue
+            print(f"[INFO] {name}.{metric}: {value:.4g} (baseline {base:.4g})")
+            if is_regression(metric, value, base, threshold):
+                regressions.append(f"{name}.{metric}: {value:.4g} vs {base:.4g}")
+    return regressions
+
+
+def git_commit() -> str:
+    """Get the commit of the working tree, empty if unknown."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def benchmark(
+    output: str, baseline: str = None, threshold: float = 0.1, only: List[str] = None
+):
+    """Run the benchmark suite headlessly on CPU and store the results in JSON
+
+    Each benchmark runs in a fresh process, so that its peak memory is its own.
+    If a baseline is given, the script fails when a metric regressed beyond the
+    threshold. The import time budget is enforced by test/test_imports.py.
+
+    Example:
+        python benchmark.py -o bench.json -b baseline.json -t 0.1
+    """
+    config_rl = lib.utils.load_config("config_rl.yaml")
+    config_ml = lib.utils.load_config("config_ml.yaml")
+    suite = benchmarks(config_rl, config_ml)
+    results = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "cpus": os.cpu_count(),
+        },
+        "results": {},
+    }
+    for name, (function, bench_args) in suite.items():
+        if only and name not in only:
+            continue
+        # not a Pool, whose daemonic workers cannot start DataLoader workers
+        with ProcessPoolExecutor(1, multiprocessing.get_context("spawn")) as pool:
+            results["results"][name] = pool.submit(function, *bench_args).result()
+        print(f"[INFO] {name} {results['results'][name]}")
+
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"[INFO] Results written to {output}")
+
+    if baseline is not None:
+        with open(baseline, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), threshold)
+        if regressions:
+            print("[ERROR] Regressions beyond the threshold:")
+            print("\n".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-o", "--output", default="benchmark.json", help="JSON path")
+    parser.add_argument("-b", "--baseline", help="JSON of a run to compare to")
+    parser.add_argument(
+        "-t", "--threshold", type=float, default=0.1, help="Tolerated change"
+    )
+    parser.add_argument("--only", nargs="+", help="Benchmarks to run, e.g. model")
+    args = parser.parse_args()
+
+    benchmark(args.output, args.baseline, args.threshold, args.only)
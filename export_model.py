@@ -0,0 +1,190 @@
+""" Export a ML or RL model as a quantized TorchScript (or ONNX) policy """
+
+import argparse
+import os
+import time
+
+import numpy as np
+import torch
+from stable_baselines3 import PPO
+
+import lib.env
+import lib.export
+import lib.utils
+import run_ml
+import run_rl
+
+
+def collect_observations(config: dict, model, n_steps: int) -> np.array:
+    """Collect the observations of an env played by a model
+
+    Args:
+        config : config parameters the model was trained with
+        model : the model
+        n_steps : number of observations
+
+    Returns:
+        The observations, of shape (n_steps, height, width, stacks)
+    """
+    env = lib.env.create_stacked_env(
+        config["stacks"], **lib.env.preprocessing_from_config(config)
+    )
+    state = env.reset()
+    observations = []
+    for _ in range(n_steps):
+        observations.append(state[0].copy())
+        action, _ = model.predict(state)
+        state, _, _, _ = env.step(action)  # the VecEnv resets itself when done
+    env.close()
+    return np.stack(observations)
+
+
+def latency_ms(predict, state: np.array, n_reps: int = 100) -> float:
+    """Time a predict function on a state, after a warm-up call
+
+    Args:
+        predict : the predict function
+        state : a batch of observations
+        n_reps : number of timed calls
+
+    Returns:
+        The latency of a call in ms
+    """
+    predict(state)
+    start = time.perf_counter()
+    for _ in range(n_reps):
+        predict(state)
+    return (time.perf_counter() - start) / n_reps * 1e3
+
+
+def human_accuracy(config: dict, policies: dict, max_samples: int) -> dict:
+    """Compute the accuracy of policies on the test human data
+
+    Args:
+        config : config parameters the policies were trained with
+        policies : the predict functions, by name
+        max_samples : maximum number of test samples
+
+    Returns:
+        The accuracy of each policy in percent, as in metrics.csv, empty if
+        there is no human data
+    """
+    if not os.path.exists(config["data_path"]):
+        return {}
+    data = lib.env.load_human_data(config["data_path"])
+    _, test_loader = lib.utils.transform_data(data, config)
+    correct = {name: 0 for name in policies}
+    total = 0
+    for images, labels in test_loader:
+        # (n, 1, stacks, height, width) floats to the observations of the envs
+        obs = images.squeeze(1).permute(0, 2, 3, 1).to(torch.uint8).numpy()
+        for name, predict in policies.items():
+            correct[name] += int((predict(obs)[0] == labels.numpy()).sum())
+        total += len(labels)
+        if total >= max_samples:
+            break
+    return {f"accuracy_{name}": 100 * c / max(total, 1) for name, c in correct.items()}
+
+
+def export(  # pylint: disable=R0913
+    actor: torch.nn.Module,
+    model,
+    config: dict,
+    path: str,
+    onnx: bool,
+    n_samples: int,
+) -> dict:
+    """Quantize and export an actor, then check it against the fp32 model
+
+    Args:
+        actor : the fp32 actor, see lib.export
+        model : the fp32 model, to play the env the observations come from
+        config : config parameters the model was trained with
+        path : path of the exported artifact, without extension
+        onnx : whether to export the fp32 actor as ONNX too
+        n_samples : number of observations of the parity check
+
+    Returns:
+        The parity, latency and size of the artifacts
+    """
+    actor.eval()
+    obs = collect_observations(config, model, n_samples)
+    lib.export.export_torchscript(lib.export.quantize(actor), obs[:1], path + ".pt")
+    exported = {"int8": lib.export.load_exported(path + ".pt")}
+    if onnx:
+        lib.export.export_onnx(actor, obs[:1], path + ".onnx")
+        exported["onnx"] = lib.export.load_exported(path + ".onnx")
+
+    results = {}
+    for name, policy in exported.items():
+        for key, value in lib.export.parity(actor, policy, obs).items():
+            results[f"{key}_{name}"] = value
+        results[f"latency_ms_{name}"] = latency_ms(policy.predict, obs[:1])
+        results[f"size_mb_{name}"] = lib.export.artifact_size_mb(policy.path)
+    with torch.inference_mode():
+        results["latency_ms_fp32"] = latency_ms(
+            lambda o: actor(torch.from_numpy(o)), obs[:1]  # pylint: disable=E1101
+        )
+    print(f"[INFO] Exported to {path}.pt {results}")
+    return results
+
+
+def export_ml(directory: str, onnx: bool = False, n_samples: int = 512):
+    """Export a ML model, and check its accuracy against the fp32 model
+
+    Example:
+        python export_model.py -d="data/models/b6YCgIyFr1sO5iWtTSKkdvEH4Smm8Lgr"
+    """
+    config = lib.utils.load_config(os.path.join(directory, "config.yaml"))
+    model = run_ml.load_ml_model(directory, config)
+    model.eval()
+    path = os.path.splitext(os.path.join(directory, run_ml.EXPORTED_ML_FILE))[0]
+    results = export(lib.export.MLActor(model), model, config, path, onnx, n_samples)
+    results["size_mb_fp32"] = lib.export.artifact_size_mb(
+        os.path.join(directory, "model_cnn.pyt")
+    )
+    exported = lib.export.load_exported(path + ".pt")
+    results.update(
+        human_accuracy(
+            config, {"fp32": model.predict, "int8": exported.predict}, n_samples
+        )
+    )
+    print(f"[INFO] {results}")
+
+
+def export_rl(
+    directory: str, file: str = None, onnx: bool = False, n_samples: int = 512
+):
+    """Export the actor of a RL model, and check it against the fp32 model
+
+    Example:
+        python export_model.py -d="data/models/50bkOHBpXFl2RnGJVImI1MzvI9iXvF26" --rl
+    """
+    config = lib.utils.load_config(os.path.join(directory, "config.yaml"))
+    model_path, _ = run_rl.rl_model_path(directory, file)
+    model = PPO.load(model_path, device="cpu")
+    path = os.path.splitext(model_path)[0] + ".int8"
+    results = export(
+        lib.export.RLActor(model.policy), model, config, path, onnx, n_samples
+    )
+    results["size_mb_fp32"] = lib.export.artifact_size_mb(model_path)
+    print(f"[INFO] {results}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--directory", help="Directory containing the model")
+    parser.add_argument("-f", "--file", help="File containing the RL model")
+    parser.add_argument("--rl", action="store_true", help="Export a RL model")
+    parser.add_argument("--onnx", action="store_true", help="Export as ONNX too")
+    parser.add_argument(
+        "-n", "--samples", type=int, default=512, help="Samples of the parity check"
+    )
+    args = parser.parse_args()
+
+    if args.directory is None:
+        raise TypeError("missing 1 positional parameter (-d or --directory)")
+    if args.rl or args.file is not None:
+        export_rl(args.directory, args.file, args.onnx, args.samples)
+    else:
+        export_ml(args.directory, args.onnx, args.samples)
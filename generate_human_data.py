@@ -1,17 +1,36 @@
 """ Let a human play the game """
 
+import argparse
+
 import lib.env
-import lib.model_rl
 import lib.play_human
 import lib.utils
 
 
-def generate_human_data():
-    """Let a human play the game and record actions and states"""
+def generate_human_data(record_states: bool = True, seed: int = None):
+    """Let a human play the game and record actions and states
+
+    Example:
+        python generate_human_data.py --actions-only
+    """
     env = lib.env.create_unstacked_env()
-    save_callback = lib.play_human.SaveCallback("./data/human")
-    lib.play_human.play_human(env, save_callback.call)
+    if seed is not None:
+        env.seed(seed)
+    save_callback = lib.play_human.SaveCallback(
+        "./data/human", record_states=record_states, seed=seed
+    )
+    lib.play_human.play_human(env, save_callback)
 
 
 if __name__ == "__main__":
-    generate_human_data()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-a",
+        "--actions-only",
+        action="store_true",
+        help="Record only the actions, the states are replayed on demand",
+    )
+    parser.add_argument("-s", "--seed", type=int, help="Seed of the environment")
+    args = parser.parse_args()
+
+    generate_human_data(not args.actions_only, args.seed)
@@ -0,0 +1,50 @@
+""" Run the scripts of the repository as subcommands
+
+Only the script of the subcommand is imported, so that e.g. evaluating a model
+does not import the training stack.
+
+Example:
+    python -m lib run-rl -d="data/models/50bkOHBpXFl2RnGJVImI1MzvI9iXvF26" -n=32
+"""
+
+import runpy
+import sys
+
+# script run by each subcommand, taking the remaining arguments
+COMMANDS = {
+    "benchmark": "benchmark",
+    "export": "export_model",
+    "generate-human-data": "generate_human_data",
+    "run-ml": "run_ml",
+    "run-rl": "run_rl",
+    "sweep": "sweep",
+    "sweep-rl": "sweep_rl",
+    "train-ml": "train_ml",
+    "train-rl": "train_rl",
+    "update-rl": "update_rl",
+}
+
+
+def usage() -> str:
+    """Get the usage of the CLI"""
+    return "usage: python -m lib {" + ",".join(COMMANDS) + "} [args ...]"
+
+
+def main(argv: list) -> None:
+    """Run the script of a subcommand as __main__
+
+    Args:
+        argv : the subcommand and the arguments of its script
+    """
+    if not argv or argv[0] in ["-h", "--help"]:
+        print(usage())
+        return
+    if argv[0] not in COMMANDS:
+        sys.exit(f"{usage()}\nunknown command {argv[0]}")
+    module = COMMANDS[argv[0]]
+    sys.argv = [f"{module}.py", *argv[1:]]
+    runpy.run_module(module, run_name="__main__", alter_sys=True)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,65 +1,599 @@
-""" Facades to create environments """
+""" Facades to create environments
 
-from typing import List, Tuple
+stable_baselines3 (hence torch) and pandas are imported by the functions using
+them, see lib.utils.
+"""
 
+from __future__ import annotations
+
+import multiprocessing
+import os
+import shutil
+import time
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator, List, Optional, Tuple
+
+import gym
 import gym_super_mario_bros
 import numpy as np
 from gym.wrappers.gray_scale_observation import GrayScaleObservation
+from gym.wrappers.time_limit import TimeLimit
 from gym_super_mario_bros.actions import SIMPLE_MOVEMENT
 from gym_super_mario_bros.smb_env import SuperMarioBrosEnv
+from nes_py.nes_env import SCREEN_HEIGHT, SCREEN_WIDTH
 from nes_py.wrappers import JoypadSpace
-from stable_baselines3.common.vec_env.dummy_vec_env import DummyVecEnv
-from stable_baselines3.common.vec_env.vec_frame_stack import VecFrameStack
 
+import lib.profiling
+import lib.utils
+
+if TYPE_CHECKING:
+    import pandas as pd
+    from stable_baselines3.common.vec_env.base_vec_env import VecEnv
+
+
+class PreprocessObservation(gym.ObservationWrapper):
+    """Crop and downsample the grayscale observations, see lib.utils.preprocess_frame"""
+
+    def __init__(self, env: gym.Env, crop_top: int = 0, resize: int = 0) -> None:
+        super().__init__(env)
+        self.crop_top = crop_top
+        self.resize = resize
+        shape = lib.utils.preprocessed_shape(
+            env.observation_space.shape, crop_top, resize
+        )
+        self.observation_space = gym.spaces.Box(
+            low=0, high=255, shape=shape, dtype=np.uint8
+        )
+
+    def observation(self, observation: np.array) -> np.array:
+        """Preprocess an observation"""
+        return lib.utils.preprocess_frame(observation, self.crop_top, self.resize)
+
+
+class SnapshotReset(gym.Wrapper):
+    """Start episodes from snapshots of the emulator instead of the stage start.
+
+    A snapshot is the sequence of actions leading from the reset state to the
+    snapshotted state: the NES being deterministic, replaying it restores the
+    emulator. The restored state is then backed up in place of the stage start
+    (nes_py keeps a single in-memory backup), so that the next resets restore
+    it without emulating anything. Every `redraw_every` resets, the start state
+    is drawn again: a snapshot of the pool with probability `probability`, the
+    stage start otherwise.
+    """
+
+    def __init__(
+        self,
+        env: gym.Env,
+        snapshots: List[np.array],
+        probability: float = 1.0,
+        redraw_every: int = 1,
+    ) -> None:
+        super().__init__(env)
+        self.snapshots = snapshots
+        self.probability = probability
+        self.redraw_every = redraw_every
+        self.rng = np.random.default_rng()
+        self.n_resets = 0
+        self.restored = False  # whether the backup is a snapshot
+
+    def seed(self, seed: Optional[int] = None) -> list:
+        """Seed the choice of the snapshots and the environment"""
+        self.rng = np.random.default_rng(seed)
+        return self.env.seed(seed)
+
+    def reset(self, **kwargs) -> np.array:
+        """Reset the environment to its backup, drawing a new one if it is time"""
+        self.n_resets += 1
+        if (self.n_resets - 1) % self.redraw_every:
+            return self.env.reset(**kwargs)
+        if self.restored:
+            restart(self.env)
+            self.restored = False
+        observation = self.env.reset(**kwargs)
+        if not self.snapshots or self.rng.random() >= self.probability:
+            return observation
+        snapshot = self.snapshots[self.rng.integers(len(self.snapshots))]
+        for action in snapshot:
+            observation, _, done, _ = self.env.step(action)
+            if done:  # the snapshot does not fit this environment, start over
+                return self.env.reset(**kwargs)
+        self.env.unwrapped._backup()  # pylint: disable=W0212
+        self.restored = True
+        return observation
+
+
+def restart(env: gym.Env) -> None:
+    """Emulate the stage start again and back it up, as SuperMarioBrosEnv does
+    on creation, after SnapshotReset replaced the backup.
+
+    Args:
+        env : the environment
+    """
+    # pylint: disable=W0212
+    env.unwrapped._has_backup = False
+    env.reset()
+    env.unwrapped._skip_start_screen()
+    env.unwrapped._backup()
+
+
+def harvest_snapshots(
+    actions: np.array, every: int, env_id: str = "SuperMarioBros-v0"
+) -> List[np.array]:
+    """Take snapshots along a sequence of actions, e.g. a human run or a rollout.
+
+    The actions are replayed headless the way play_human recorded them: the
+    environment is reset at the end of each episode. A snapshot is taken every
+    `every` steps of each episode.
+
+    Args:
+        actions : the actions, in the SIMPLE_MOVEMENT action space
+        every : number of steps between two snapshots
+        env_id : id of the environment the actions were played on
+
+    Returns:
+        The snapshots, as the actions leading to each snapshotted state
+    """
+    env = JoypadSpace(gym_super_mario_bros.make(env_id), SIMPLE_MOVEMENT)
+    env.reset()
+    snapshots = []
+    start = 0
+    for i, action in enumerate(actions):
+        if i > start and (i - start) % every == 0:
+            snapshots.append(np.array(actions[start:i]))
+        _, _, done, _ = env.step(int(action))
+        if done:
+            env.reset()
+            start = i + 1
+    env.close()
+    return snapshots
+
+
+def replay_states(
+    chunks: Iterable[np.array], env_id: str, seed: Optional[int]
+) -> Iterator[np.array]:
+    """Regenerate the states of a human run from its actions, chunk by chunk.
+
+    The actions are replayed headless the way play_human recorded them: each
+    state is the one observed before its action, and the environment is reset
+    at the end of each episode.
 
-def create_unstacked_env() -> SuperMarioBrosEnv:
+    Args:
+        chunks : the actions of the run, chunk by chunk
+        env_id : id of the environment the run was played on
+        seed : seed of the environment the run was played on
+
+    Returns:
+        The states of each chunk of actions
+    """
+    env = create_unstacked_env(env_id)
+    if seed is not None:
+        env.seed(seed)
+    state = env.reset()
+    for actions in chunks:
+        states = np.empty((len(actions), *env.observation_space.shape), np.uint8)
+        for i, action in enumerate(actions):
+            states[i] = state
+            state, _, done, _ = env.step(int(action))
+            if done:
+                state = env.reset()
+        yield states
+    env.close()
+
+
+def replay_run(run_path: str) -> None:
+    """Regenerate the states of a run recorded without them, see replay_states.
+
+    The states are written as compressed chunks, see lib.utils.write_chunk, one
+    per chunk of the run, so that a single chunk is held in memory. They are
+    written to a temporary directory renamed at the end, so the replay is
+    either complete or absent.
+
+    Args:
+        run_path : directory of the run
+    """
+    meta = lib.utils.run_meta(run_path)
+    chunks = [
+        lib.utils.read_chunk(p, with_states=False)[0]
+        for p in lib.utils.list_chunks(run_path)
+    ]
+    replay_path = os.path.join(run_path, lib.utils.REPLAY_DIR)
+    tmp_path = replay_path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)  # left by an interrupted replay
+    os.makedirs(tmp_path)
+    states = replay_states(chunks, meta["env_id"], meta.get("seed"))
+    for index, states_i in enumerate(states):
+        lib.utils.write_chunk(tmp_path, index, states_i, chunks[index])
+    os.rename(tmp_path, replay_path)
+
+
+def replay_runs(run_paths: List[str], processes: Optional[int] = None) -> None:
+    """Regenerate the states of runs recorded without them, in parallel.
+
+    Runs whose states have already been regenerated are skipped.
+
+    Args:
+        run_paths : directories of the runs
+        processes : number of worker processes, the number of CPUs if None
+    """
+    run_paths = [
+        p
+        for p in run_paths
+        if not os.path.exists(os.path.join(p, lib.utils.REPLAY_DIR))
+    ]
+    if not run_paths:
+        return
+    print(f"[INFO] Replaying {len(run_paths)} runs to regenerate their states")
+    with multiprocessing.get_context("forkserver").Pool(processes) as pool:
+        pool.map(replay_run, run_paths)
+
+
+def load_human_data(data_path: str) -> lib.utils.HumanData:
+    """Load all human data, see lib.utils.load_human_data, replaying first the
+    runs recorded without their states, see replay_runs.
+
+    Args:
+        data_path : Path of the directory containing all the human data
+
+    Returns:
+        A lazy dataset of the actions and states generated by humans
+    """
+    replay_runs(lib.utils.actions_only_runs(data_path))
+    return lib.utils.load_human_data(data_path)
+
+
+def snapshots_from_config(config: dict) -> dict:
+    """Harvest the snapshots of the human runs, if a config asks for them.
+
+    The snapshots are taken every `snapshot_every` steps of the human runs
+    stored in `reset_snapshots`, on the environment each run was played on, and
+    drawn with probability `snapshot_probability` every `snapshot_redraw_every`
+    resets, see SnapshotReset. Only the actions of the runs are read.
+
+    Args:
+        config : config parameters as a dict
+
+    Returns:
+        The keyword arguments of create_unstacked_env
+    """
+    if not config.get("reset_snapshots"):
+        return {}
+    snapshots = []
+    for run_path in lib.utils.list_human_runs(config["reset_snapshots"]):
+        snapshots += harvest_snapshots(
+            lib.utils.load_run_actions(run_path),
+            config.get("snapshot_every", 500),
+            lib.utils.run_meta(run_path).get("env_id", "SuperMarioBros-v0"),
+        )
+    print(f"[INFO] {len(snapshots)} snapshots harvested")
+    return {
+        "snapshots": snapshots,
+        "snapshot_probability": config.get("snapshot_probability", 1.0),
+        "snapshot_redraw_every": config.get("snapshot_redraw_every", 1),
+    }
+
+
+def create_unstacked_env(  # pylint: disable=R0913
+    env_id: str = "SuperMarioBros-v0",
+    crop_top: int = 0,
+    resize: int = 0,
+    frame_skip: int = 1,
+    max_steps: Optional[int] = None,
+    snapshots: Optional[List[np.array]] = None,
+    snapshot_probability: float = 1.0,
+    snapshot_redraw_every: int = 1,
+) -> SuperMarioBrosEnv:
     """Create an unstacked environement already preprocessed.
 
+    Args:
+        env_id : id of the gym environment, e.g. "SuperMarioBros-1-2-v0"
+        crop_top : number of rows (the HUD) removed at the top of the frames
+        resize : side of the square frames, 0 to keep the NES resolution
+        frame_skip : number of frames an action is repeated for, the
+            observation being the max over the last two of them
+        max_steps : number of steps after which an episode is truncated
+        snapshots : snapshots to start the episodes from, see SnapshotReset
+        snapshot_probability : probability to start an episode from a snapshot
+        snapshot_redraw_every : number of resets between two draws of a snapshot
+
     Returns:
         A SuperMarioBrosEnv object.
     """
-    env = gym_super_mario_bros.make("SuperMarioBros-v0")
+    env = gym_super_mario_bros.make(env_id)
     env = JoypadSpace(env, SIMPLE_MOVEMENT)
+    if snapshots:
+        env = SnapshotReset(env, snapshots, snapshot_probability, snapshot_redraw_every)
+    if frame_skip > 1:
+        from stable_baselines3.common import atari_wrappers  # pylint: disable=C0415
+
+        env = atari_wrappers.MaxAndSkipEnv(env, skip=frame_skip)
     env = GrayScaleObservation(env, keep_dim=True)
+    if crop_top or resize:
+        env = PreprocessObservation(env, crop_top, resize)
+    if max_steps is not None:
+        env = TimeLimit(env, max_episode_steps=max_steps)
     return env
 
 
-def create_stacked_env(stacks: int) -> SuperMarioBrosEnv:
+def stage_env_id(stage: str) -> str:
+    """Get the id of the environment of a single stage.
+
+    Args:
+        stage : the stage as "<world>-<stage>", e.g. "1-2"
+
+    Returns:
+        The gym id of the environment
+    """
+    return f"SuperMarioBros-{stage}-v0"
+
+
+def preprocessing_from_config(config: dict) -> dict:
+    """Get the observation preprocessing parameters of a config.
+
+    Configs saved before these parameters existed get the raw observations.
+
+    Args:
+        config : config parameters as a dict
+
+    Returns:
+        The keyword arguments of create_unstacked_env
+    """
+    return {
+        "crop_top": config.get("crop_top", 0),
+        "resize": config.get("resize", 0),
+        "frame_skip": config.get("frame_skip", 1),
+    }
+
+
+def observation_shape(config: dict) -> Tuple[int, int, int]:
+    """Get the shape of the stacked observations described by a config.
+
+    Args:
+        config : config parameters as a dict
+
+    Returns:
+        The (height, width, stacks) shape of the observations
+    """
+    height, width, _ = lib.utils.preprocessed_shape(
+        (SCREEN_HEIGHT, SCREEN_WIDTH, 1),
+        config.get("crop_top", 0),
+        config.get("resize", 0),
+    )
+    return height, width, config["stacks"]
+
+
+def make_env(
+    rank: int, seed: Optional[int] = None, **env_kwargs
+) -> Callable[[], SuperMarioBrosEnv]:
+    """Build a thunk creating an unstacked environment, to be used by a VecEnv.
+
+    Args:
+        rank : index of the environment in the VecEnv
+        seed : base seed, the environment is seeded with seed + rank
+        env_kwargs : keyword arguments of create_unstacked_env
+
+    Returns:
+        A function creating the environment (called in the worker process).
+    """
+
+    def _init() -> SuperMarioBrosEnv:
+        env = create_unstacked_env(**env_kwargs)
+        if seed is not None:
+            env.seed(seed + rank)
+        return env
+
+    return _init
+
+
+def stack_envs(
+    env_fns: List[Callable[[], SuperMarioBrosEnv]], stacks: int, vec_env: str
+) -> VecEnv:
+    """Vectorize environments and stack their frames.
+
+    Args:
+        env_fns : functions creating the environments
+        stacks : number of stacks for the env
+        vec_env : "dummy" to step the emulators sequentially in this process,
+            "subproc" to step each emulator in its own worker process
+
+    Returns:
+        A VecEnv object.
+    """
+    from stable_baselines3.common import vec_env as vec_envs  # pylint: disable=C0415
+
+    if vec_env == "subproc":
+        # forkserver avoids forking the parent's torch threads into each worker
+        env = vec_envs.SubprocVecEnv(env_fns, start_method="forkserver")
+    elif vec_env == "dummy":
+        env = vec_envs.DummyVecEnv(env_fns)
+    else:
+        raise ValueError(f"unknown vec_env {vec_env}, expected 'dummy' or 'subproc'")
+    env = vec_envs.VecFrameStack(env, stacks, channels_order="last")
+    return env
+
+
+def create_stacked_env(
+    stacks: int,
+    n_envs: int = 1,
+    vec_env: str = "dummy",
+    seed: Optional[int] = None,
+    **env_kwargs,
+) -> VecEnv:
     """Create an stacked environement already preprocessed.
 
     Args:
         stacks: number of stacks for the env
+        n_envs: number of emulators stepped in parallel
+        vec_env: "dummy" to step the emulators sequentially in this process,
+            "subproc" to step each emulator in its own worker process
+        seed: base seed of the emulators (each one gets seed + rank)
+        env_kwargs: keyword arguments of create_unstacked_env
 
     Returns:
-        A SuperMarioBrosEnv object.
+        A VecEnv object.
     """
-    env = create_unstacked_env()
-    env = DummyVecEnv([lambda: env])
-    env = VecFrameStack(env, stacks, channels_order="last")
-    return env
+    env_fns = [make_env(rank, seed, **env_kwargs) for rank in range(n_envs)]
+    return stack_envs(env_fns, stacks, vec_env)
+
+
+def create_training_env(config: dict) -> VecEnv:
+    """Create the stacked environment described by a RL config.
+
+    Args:
+        config : config parameters as a dict
 
+    Returns:
+        A VecEnv object.
+    """
+    return create_stacked_env(
+        config["stacks"],
+        n_envs=config.get("n_envs", 1),
+        vec_env=config.get("vec_env", "dummy"),
+        seed=config.get("seed"),
+        **preprocessing_from_config(config),
+        **snapshots_from_config(config),
+    )
 
-def run(env: SuperMarioBrosEnv, model) -> Tuple[np.array, List[int]]:
+
+def run(
+    env: SuperMarioBrosEnv,
+    model,
+    render: bool = False,
+    sink: Optional[lib.utils.VideoSink] = None,
+    profiler: lib.profiling.Profiler = lib.profiling.DISABLED,
+) -> List[int]:
     """Play the environment given model predictions.
 
     Args:
         env : an environement
-        model : a model
+        model : a model, or a policy exported by export_model.py, see
+            lib.export.load_exported
+        render : whether to display the environment while playing
+        sink : a video sink receiving the last frame of each stacked state
+        profiler : times the predict, step (frame stacking included), sink and
+            render phases
 
     Returns:
-        The frames and Mario's x position in the stage
+        Mario's x position in the stage
     """
-    states = []
     x_pos = []
     state = env.reset()
     done = False
     for _ in range(1000):  # limit the simulation
         if done:
             break
-        action, _ = model.predict(state)
-        state, _, done, info = env.step(action)
-        states.append(state)
+        with profiler.timer("predict"):
+            action, _ = model.predict(state)
+        with profiler.timer("step"):
+            state, _, done, info = env.step(action)
+        if sink is not None:
+            with profiler.timer("sink"):
+                sink.write(state[0, :, :, -1])
         x_pos.append(info[0]["x_pos"])
-        env.render()
+        if render:
+            with profiler.timer("render"):
+                env.render()
     env.close()
-    return np.array(states), x_pos
+    profiler.flush(len(x_pos))
+    return x_pos
+
+
+def evaluate(  # pylint: disable=R0913,R0914
+    model,
+    config: dict,
+    n_episodes: int,
+    stages: Optional[List[str]] = None,
+    n_envs: int = 1,
+    vec_env: str = "subproc",
+    max_steps: Optional[int] = None,
+    snapshots: Optional[List[np.array]] = None,
+    profiler: lib.profiling.Profiler = lib.profiling.DISABLED,
+) -> Tuple[pd.DataFrame, dict]:
+    """Evaluate a model over several episodes, played by parallel emulators.
+
+    The emulators run headless and the model predicts the actions of all of
+    them at once. Emulator i plays the stage stages[i % len(stages)].
+
+    Args:
+        model : a model
+        config : config parameters the model was trained with
+        n_episodes : number of episodes to play
+        stages : stages to play as "<world>-<stage>", the whole game if None
+        n_envs : number of emulators
+        vec_env : "subproc" to step each emulator in its own worker process,
+            "dummy" to step them sequentially in this process
+        max_steps : number of steps after which an episode is truncated
+        snapshots : snapshots to start the episodes from, see SnapshotReset
+        profiler : times the predict and step phases, counts the episodes
+
+    Returns:
+        The episodes (stage, x_pos, flag_get, steps) and aggregated statistics
+    """
+    env_ids = [stage_env_id(s) for s in stages] if stages else ["SuperMarioBros-v0"]
+    env_fns = [
+        make_env(
+            rank,
+            config.get("seed"),
+            env_id=env_ids[rank % len(env_ids)],
+            max_steps=max_steps,
+            snapshots=snapshots,
+            **preprocessing_from_config(config),
+        )
+        for rank in range(n_envs)
+    ]
+    env = stack_envs(env_fns, config["stacks"], vec_env)
+
+    # split the episodes evenly so that short episodes are not over-represented
+    targets = np.array([(n_episodes + i) // n_envs for i in range(n_envs)])
+    counts = np.zeros(n_envs, dtype=int)
+    steps = np.zeros(n_envs, dtype=int)
+    episodes = []
+    n_steps = 0
+    start = time.perf_counter()
+    state = env.reset()
+    while (counts < targets).any():
+        with profiler.timer("predict"):
+            action, _ = model.predict(state)
+        with profiler.timer("step"):
+            state, _, done, info = env.step(action)
+        n_steps += n_envs
+        steps += 1
+        for i in np.flatnonzero(done):
+            if counts[i] < targets[i]:
+                episodes.append(
+                    {
+                        "stage": env_ids[i % len(env_ids)],
+                        "x_pos": info[i]["x_pos"],
+                        "flag_get": info[i]["flag_get"],
+                        "steps": steps[i],
+                    }
+                )
+                counts[i] += 1
+                profiler.count("episodes")
+            steps[i] = 0
+    elapsed = time.perf_counter() - start
+    env.close()
+    profiler.flush(n_steps)
+
+    import pandas as pd  # pylint: disable=C0415
+
+    episodes = pd.DataFrame(episodes)
+    return episodes, episode_stats(episodes, n_steps / elapsed)
+
+
+def episode_stats(episodes: pd.DataFrame, steps_per_sec: float) -> dict:
+    """Aggregate the episodes of an evaluation, see evaluate
+
+    Args:
+        episodes : the episodes (stage, x_pos, flag_get, steps)
+        steps_per_sec : the env steps per second of the evaluation
+
+    Returns:
+        The statistics of the episodes
+    """
+    return {
+        "episodes": len(episodes),
+        "mean_x_pos": episodes["x_pos"].mean(),
+        "max_x_pos": episodes["x_pos"].max(),
+        "completion_rate": episodes["flag_get"].mean(),
+        "steps_per_sec": steps_per_sec,
+    }
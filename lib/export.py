@@ -0,0 +1,178 @@
+""" Export ML and RL policies as quantized TorchScript or ONNX artifacts
+
+An exported policy takes the observations as the environments give them, a
+uint8 batch of shape (n_envs, height, width, stacks), and returns the logits of
+the actions. It is loaded with torch.jit (or onnxruntime) alone, without the
+training stack, see load_exported.
+"""
+
+import os
+from typing import Tuple
+
+import numpy as np
+import torch
+from torch import nn
+
+
+class MLActor(nn.Module):
+    """Wrap a lib.model_ml.PolicyModel to take the observations of the envs"""
+
+    def __init__(self, model: nn.Module) -> None:
+        super().__init__()
+        self.model = model
+
+    def forward(self, obs: torch.Tensor) -> torch.Tensor:
+        """Compute the logits of the actions from uint8 stacked observations"""
+        return self.model(obs.permute(0, 3, 1, 2).unsqueeze(1).float())
+
+
+class RLActor(nn.Module):
+    """Wrap the actor of a SB3 ActorCriticCnnPolicy (e.g. PPO's policy)
+
+    The value network is dropped. The actions are the most likely ones, as
+    PPO.predict(deterministic=True).
+    """
+
+    def __init__(self, policy: nn.Module) -> None:
+        super().__init__()
+        self.policy = policy
+
+    def forward(self, obs: torch.Tensor) -> torch.Tensor:
+        """Compute the logits of the actions from uint8 stacked observations"""
+        # SB3 transposes image observations to channels first, then scales them
+        features = self.policy.extract_features(obs.permute(0, 3, 1, 2))
+        latent_pi, _ = self.policy.mlp_extractor(features)
+        return self.policy.action_net(latent_pi)
+
+
+def quantize(actor: nn.Module) -> nn.Module:
+    """Quantize the linear layers of an actor to int8, dynamically.
+
+    The weights are stored as int8 and the activations quantized on the fly;
+    the linear layers hold most of the weights of the models of this repo.
+
+    Args:
+        actor : the actor, in eval mode
+
+    Returns:
+        The quantized actor
+    """
+    return torch.quantization.quantize_dynamic(
+        actor, {nn.Linear}, dtype=torch.qint8  # pylint: disable=E1101
+    )
+
+
+def export_torchscript(actor: nn.Module, example: np.array, path: str) -> None:
+    """Trace an actor and save it as TorchScript.
+
+    Args:
+        actor : the actor, in eval mode
+        example : a batch of observations to trace with
+        path : path of the .pt file
+    """
+    example = torch.from_numpy(example)  # pylint: disable=E1101
+    with torch.inference_mode():
+        traced = torch.jit.trace(actor, example)
+    traced.save(path)
+
+
+def export_onnx(actor: nn.Module, example: np.array, path: str) -> None:
+    """Export an actor as ONNX, with a dynamic batch size.
+
+    Args:
+        actor : the actor, in eval mode, not quantized
+        example : a batch of observations to trace with
+        path : path of the .onnx file
+    """
+    torch.onnx.export(
+        actor,
+        torch.from_numpy(example),  # pylint: disable=E1101
+        path,
+        input_names=["obs"],
+        output_names=["logits"],
+        dynamic_axes={"obs": {0: "batch"}, "logits": {0: "batch"}},
+    )
+
+
+class ExportedPolicy:
+    """An exported policy, with the predict method of the models."""
+
+    def __init__(self, path: str) -> None:
+        """
+        Args:
+            path : path of a .pt (TorchScript) or .onnx file
+        """
+        self.path = path
+        if path.endswith(".onnx"):
+            # only needed for ONNX policies
+            import onnxruntime  # pylint: disable=C0415,E0401
+
+            self.session = onnxruntime.InferenceSession(
+                path, providers=["CPUExecutionProvider"]
+            )
+            self.module = None
+        else:
+            self.session = None
+            self.module = torch.jit.load(path, map_location="cpu")
+            self.module.eval()
+
+    def logits(self, state: np.array) -> np.array:
+        """Compute the logits of the actions given a batch of states
+
+        Args:
+            state : the states of a vectorized env, of shape (n_envs, height,
+                width, stacks)
+
+        Returns:
+            The logits, of shape (n_envs, n_actions)
+        """
+        state = np.ascontiguousarray(state, dtype=np.uint8)
+        if self.session is not None:
+            return self.session.run(None, {"obs": state})[0]
+        with torch.inference_mode():
+            return self.module(torch.from_numpy(state)).numpy()  # pylint: disable=E1101
+
+    def predict(self, state: np.array) -> Tuple[np.array, None]:
+        """Predict the actions given a batch of states, see logits
+
+        Returns:
+            The actions predicted, one per env
+        """
+        return self.logits(state).argmax(axis=1), None
+
+
+def load_exported(path: str) -> ExportedPolicy:
+    """Load a policy exported by export_model.py
+
+    Args:
+        path : path of the .pt or .onnx file
+
+    Returns:
+        The policy
+    """
+    return ExportedPolicy(path)
+
+
+def parity(reference: nn.Module, exported: ExportedPolicy, obs: np.array) -> dict:
+    """Compare the actions of an exported policy to those of its fp32 actor.
+
+    Args:
+        reference : the fp32 actor, in eval mode
+        exported : the exported policy
+        obs : a batch of observations
+
+    Returns:
+        The agreement of the actions and the max difference of the logits
+    """
+    with torch.inference_mode():
+        expected = reference(torch.from_numpy(obs)).numpy()  # pylint: disable=E1101
+    logits = exported.logits(obs)
+    return {
+        "agreement": float((expected.argmax(axis=1) == logits.argmax(axis=1)).mean()),
+        "max_logit_diff": float(np.abs(expected - logits).max()),
+    }
+
+
+def artifact_size_mb(path: str) -> float:
+    """Get the size of an artifact in MB"""
+    return os.path.getsize(path) / 2**20
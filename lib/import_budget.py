@@ -0,0 +1,61 @@
+""" Import time budget of the entry points
+
+Checked by test/test_imports.py and reported by benchmark.py. This module only
+imports the standard library, not to weigh on the imports it times.
+"""
+
+import os
+import subprocess
+import sys
+from typing import List, Tuple
+
+# import time budget of the entry points, in ms, and the heavy modules they
+# must not import, see lib.utils
+IMPORT_BUDGET_MS = {
+    "lib.utils": 300,
+    "lib.profiling": 300,
+    "lib.env": 1500,
+    "lib.serving": 1500,
+    "lib.__main__": 100,
+    "run_ml": 1500,
+    "run_rl": 1500,
+    "train_ml": 1500,
+    "train_rl": 1500,
+    "update_rl": 1500,
+}
+HEAVY_MODULES = [
+    "torch",
+    "cv2",
+    "pandas",
+    "matplotlib",
+    "sklearn",
+    "stable_baselines3",
+]
+# root of the repository, from where the entry points are imported
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_time(module: str) -> Tuple[float, List[str]]:
+    """Time the import of a module in a fresh interpreter.
+
+    Args:
+        module : name of the module, importable from the root of the repository
+
+    Returns:
+        The import time in ms and the heavy modules imported along
+    """
+    code = (
+        "import sys, time\n"
+        "start = time.perf_counter()\n"
+        f"import {module}\n"
+        "print((time.perf_counter() - start) * 1e3)\n"
+        f"print(*[m for m in {HEAVY_MODULES!r} if m in sys.modules])\n"
+    )
+    lines = subprocess.run(
+        [sys.executable, "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+        cwd=ROOT,
+    ).stdout.splitlines()
+    return float(lines[0]), lines[1].split()
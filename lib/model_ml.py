@@ -1,17 +1,93 @@
 """ Model ML related functions """
 
-from typing import Tuple
+import resource
+import time
+from typing import Callable, Optional, Tuple
 
 import numpy as np
 import pandas as pd
 import torch
 from torch import nn
 
+import lib.profiling
 
-class CNNModel(nn.Module):
+
+class PolicyModel(nn.Module):
+    """A model predicting actions from stacks of frames.
+
+    The input of forward is a float batch of shape (n, in_channels, stacks,
+    height, width), as assembled by lib.utils.FrameStackDataset.
+    """
+
+    # memory format of the parameters with the channels_last option
+    channels_last_format = torch.channels_last  # pylint: disable=E1101
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.input_buffer = None
+
+    def predict(self, state: np.array) -> Tuple[np.array, None]:
+        """Predict the actions given a batch of states
+
+        Args:
+            state : the states of a vectorized env, of shape (n_envs, height,
+                width, stacks)
+
+        Returns:
+            The actions predicted, one per env
+        """
+        self.eval()
+        with torch.inference_mode():
+            frames = self._input_buffer(state.shape)
+            frames.copy_(
+                torch.from_numpy(state)  # pylint: disable=E1101
+                .permute(0, 3, 1, 2)
+                .unsqueeze(1)
+            )
+            predicted = self(frames).argmax(dim=1)
+        return predicted.numpy(), None  # for compatibility reason with RL models
+
+    def _input_buffer(self, shape: Tuple[int, ...]) -> torch.Tensor:
+        """Get the preallocated input tensor, reallocated only if the shape changes
+
+        Args:
+            shape : shape of the states, (n_envs, height, width, stacks)
+
+        Returns:
+            A float tensor of shape (n_envs, 1, stacks, height, width)
+        """
+        n_envs, height, width, stacks = shape
+        input_shape = (n_envs, 1, stacks, height, width)
+        if self.input_buffer is None or tuple(self.input_buffer.shape) != input_shape:
+            self.input_buffer = torch.empty(input_shape)  # pylint: disable=E1101
+        return self.input_buffer
+
+    def save(self, path: str) -> None:
+        """Save the model
+
+        Args:
+            path : path to save the model
+        """
+        torch.save(self.state_dict(), path)
+
+
+class CNNModel(PolicyModel):
     """A Conv3D model"""
 
-    def __init__(self, nclasses: int, in_channels: int):
+    channels_last_format = torch.channels_last_3d  # pylint: disable=E1101
+
+    def __init__(
+        self,
+        nclasses: int,
+        in_channels: int,
+        input_shape: Tuple[int, int, int] = (4, 240, 256),
+    ):
+        """
+        Args:
+            nclasses : number of actions
+            in_channels : number of channels of the frames
+            input_shape : (stacks, height, width) of the input
+        """
         super().__init__()
 
         self.conv_layer1 = nn.Sequential(
@@ -19,7 +95,11 @@ class CNNModel(nn.Module):
             nn.LeakyReLU(),
             nn.MaxPool3d((2, 2, 2)),
         )
-        self.fc1 = nn.Linear(483616, 128)
+        with torch.no_grad():
+            conv_output = self.conv_layer1(
+                torch.zeros(1, in_channels, *input_shape)  # pylint: disable=E1101
+            )
+        self.fc1 = nn.Linear(conv_output.numel(), 128)
         self.fc2 = nn.Linear(128, nclasses)
         self.relu = nn.LeakyReLU()
         self.batch = nn.BatchNorm1d(128)
@@ -36,35 +116,294 @@ class CNNModel(nn.Module):
         out = self.fc2(out)
         return out
 
-    def predict(self, state: np.array) -> Tuple[np.array, None]:
-        """Predict the action given the state
 
-        Args:
-            state : the state
+def depthwise_block(channels: int) -> nn.Sequential:
+    """A depthwise separable convolution block, keeping the spatial size
 
-        Returns:
-            The action predicted
-        """
-        states = np.array([state, state])
-        states = (
-            torch.from_numpy(states)  # pylint: disable=E1101
-            .permute(0, 1, 4, 2, 3)
-            .float()
-        )
-        data_loader = torch.utils.data.DataLoader(states, batch_size=2, shuffle=False)
-        for frames in data_loader:
-            outputs = self(frames)
-            predicted = torch.max(outputs.data, 1)[1]  # pylint: disable=E1101
-        action = np.array([predicted[0]])
-        return action, None  # for compatibility reason with RL models
+    Args:
+        channels : number of input and output channels
 
-    def save(self, path: str) -> None:
-        """Save the model
+    Returns:
+        The block
+    """
+    return nn.Sequential(
+        nn.Conv2d(channels, channels, kernel_size=3, padding=1, groups=channels),
+        nn.Conv2d(channels, channels, kernel_size=1),
+        nn.BatchNorm2d(channels),
+        nn.ReLU(),
+    )
 
+
+class CompactCNNModel(PolicyModel):
+    """A compact Conv2D model, sized for real-time play.
+
+    The stacked frames are the channels of strided 2D convolutions, followed by
+    a depthwise separable block and an adaptive pooling, so that the head does
+    not grow with the resolution of the frames. About 0.2M parameters against
+    62M for CNNModel on full NES frames.
+    """
+
+    def __init__(  # pylint: disable=R0913
+        self,
+        nclasses: int,
+        in_channels: int,
+        input_shape: Tuple[int, int, int] = (4, 84, 84),
+        width: int = 32,
+        pool: int = 4,
+    ):
+        """
         Args:
-            path : path to save the model
+            nclasses : number of actions
+            in_channels : number of channels of the frames
+            input_shape : (stacks, height, width) of the input
+            width : number of channels of the first convolution, doubled after
+            pool : side of the feature map fed to the head
         """
-        torch.save(self.state_dict(), path)
+        super().__init__()
+        stacks = input_shape[0]
+        self.features = nn.Sequential(
+            nn.Conv2d(in_channels * stacks, width, kernel_size=8, stride=4),
+            nn.ReLU(),
+            nn.Conv2d(width, 2 * width, kernel_size=4, stride=2),
+            nn.ReLU(),
+            depthwise_block(2 * width),
+            nn.AdaptiveAvgPool2d(pool),
+        )
+        self.head = nn.Sequential(
+            nn.Flatten(),
+            nn.Linear(2 * width * pool * pool, 128),
+            nn.ReLU(),
+            nn.Dropout(p=0.15),
+            nn.Linear(128, nclasses),
+        )
+
+    def forward(self, x):
+        """Feed forward the data"""
+        # the channels and the stacked frames are the channels of the Conv2d
+        out = x.flatten(1, 2) / 255
+        out = self.features(out)
+        return self.head(out)
+
+
+# the models selectable with the `model` key of config_ml.yaml
+MODELS = {"cnn3d": CNNModel, "compact": CompactCNNModel}
+
+
+def create_model(
+    config: dict,
+    nclasses: int,
+    input_shape: Tuple[int, int, int],
+    in_channels: int = 1,
+) -> PolicyModel:
+    """A factory of ML models, the model being the `model` key of a config
+
+    Configs without this key, saved before it existed, create a CNNModel.
+
+    Args:
+        config : a config file
+        nclasses : number of actions
+        input_shape : (stacks, height, width) of the input
+        in_channels : number of channels of the frames
+
+    Returns:
+        The initialized model
+    """
+    model_class = MODELS[config.get("model", "cnn3d")]
+    return model_class(nclasses, in_channels, input_shape=input_shape)
+
+
+def load_model(
+    path: str, config: dict, nclasses: int, input_shape: Tuple[int, int, int]
+) -> PolicyModel:
+    """Load a model saved by PolicyModel.save, on CPU
+
+    Args:
+        path : path of the model
+        config : the config the model was trained with, see create_model
+        nclasses : number of actions
+        input_shape : (stacks, height, width) of the input
+
+    Returns:
+        The model
+    """
+    model = create_model(config, nclasses, input_shape)
+    model.load_state_dict(torch.load(path, map_location="cpu"))
+    return model
+
+
+def setup_training(model: nn.Module, config: dict) -> nn.Module:
+    """Apply the performance options of a config before training
+
+    Options are `num_threads` (0 keeps torch's default), `channels_last` (use
+    the channels-last memory format) and `compile` (torch.compile the model,
+    requires torch>=2.0).
+
+    Args:
+        model : the model, converted in place to the memory format
+        config : a config file
+
+    Returns:
+        The module to call for the forward pass, the compiled model if any
+    """
+    if config.get("num_threads", 0):
+        torch.set_num_threads(config["num_threads"])
+    if config.get("channels_last", False):
+        model.to(memory_format=model.channels_last_format)
+    if config.get("compile", False):
+        if hasattr(torch, "compile"):
+            return torch.compile(model)
+        print("[WARNING] torch.compile requires torch>=2.0, the model is not compiled")
+    return model
+
+
+def training_step(  # pylint: disable=R0913
+    net: nn.Module,
+    images: torch.Tensor,
+    labels: torch.Tensor,
+    error: nn.Module,
+    optimizer: torch.optim.Optimizer,
+    config: dict,
+    profiler: lib.profiling.Profiler = lib.profiling.DISABLED,
+) -> torch.Tensor:
+    """Do a training step, with the precision and memory format of a config
+
+    Args:
+        net : the module to call for the forward pass
+        images : a batch of stacked frames
+        labels : the actions of the batch
+        error : the loss
+        optimizer : the optimizer
+        config : a config file
+        profiler : times the forward, backward and optimizer phases
+
+    Returns:
+        The loss of the batch
+    """
+    if config.get("channels_last", False):
+        images = images.contiguous(
+            memory_format=torch.channels_last_3d  # pylint: disable=E1101
+        )
+    optimizer.zero_grad()  # clear gradients
+    with profiler.timer("forward"), torch.autocast(
+        "cpu",
+        dtype=torch.bfloat16,  # pylint: disable=E1101
+        enabled=config.get("precision", "fp32") == "bf16",
+    ):
+        outputs = net(images)  # forward prop
+        loss = error(outputs, labels)  # entropy loss
+    with profiler.timer("backward"):
+        loss.backward()  # compute gradients
+    with profiler.timer("optimizer"):
+        optimizer.step()  # update parameters
+    return loss
+
+
+def benchmark(
+    model: nn.Module,
+    train_loader: torch.utils.data.DataLoader,
+    config: dict,
+    n_steps: int,
+) -> dict:
+    """Time training steps with the performance options of a config
+
+    The first batch is a warm-up and is not timed.
+
+    Args:
+        model : the model
+        train_loader : train data
+        config : a config file
+        n_steps : number of timed training steps
+
+    Returns:
+        The samples/sec and the peak memory (resident set size) of the process
+    """
+    net = setup_training(model, config)
+    error = nn.CrossEntropyLoss()
+    optimizer = torch.optim.SGD(model.parameters(), lr=config["learning_rate"])
+
+    model.train()
+    samples = 0
+    start = None
+    step = 0
+    while step < n_steps:
+        for images, labels in train_loader:
+            training_step(net, images, labels, error, optimizer, config)
+            if start is None:
+                start = time.perf_counter()
+                continue
+            samples += len(labels)
+            step += 1
+            if step >= n_steps:
+                break
+    elapsed = time.perf_counter() - start
+
+    return {
+        "samples_per_sec": samples / elapsed,
+        "peak_memory_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def compute_accuracy(
+    net: nn.Module, loader: torch.utils.data.DataLoader, config: dict
+) -> float:
+    """Compute the accuracy of a model, in eval mode and without autograd
+
+    Args:
+        net : the module to call for the forward pass
+        loader : the data to evaluate on
+        config : a config file
+
+    Returns:
+        The accuracy in percent
+    """
+    net.eval()
+    correct = torch.zeros((), dtype=torch.long)  # pylint: disable=E1101
+    total = 0
+    with torch.inference_mode(), torch.autocast(
+        "cpu",
+        dtype=torch.bfloat16,  # pylint: disable=E1101
+        enabled=config.get("precision", "fp32") == "bf16",
+    ):
+        for images, labels in loader:
+            predicted = net(images).argmax(dim=1)
+            correct += (predicted == labels).sum()
+            total += len(labels)
+    net.train()
+    return 100 * correct.item() / max(total, 1)
+
+
+def subsample_loader(
+    loader: torch.utils.data.DataLoader, n_samples: int, seed: int
+) -> torch.utils.data.DataLoader:
+    """Restrict a loader to a fixed random subsample of its data
+
+    The new loader has the same workers settings as the original one.
+
+    Args:
+        loader : the loader
+        n_samples : size of the subsample, 0 to keep all the data
+        seed : seed of the subsample
+
+    Returns:
+        A loader over the subsample
+    """
+    if not n_samples or n_samples >= len(loader.dataset):
+        return loader
+    idx = np.random.default_rng(seed).choice(
+        len(loader.dataset), n_samples, replace=False
+    )
+    loader_kwargs = {
+        "batch_size": loader.batch_size,
+        "collate_fn": loader.collate_fn,
+        "num_workers": loader.num_workers,
+        "pin_memory": loader.pin_memory,
+    }
+    if loader.num_workers:
+        loader_kwargs["prefetch_factor"] = loader.prefetch_factor
+        loader_kwargs["persistent_workers"] = loader.persistent_workers
+    return torch.utils.data.DataLoader(
+        torch.utils.data.Subset(loader.dataset, np.sort(idx)), **loader_kwargs
+    )
 
 
 def learn(  # pylint: disable=R0914
@@ -72,57 +411,99 @@ def learn(  # pylint: disable=R0914
     train_loader: torch.utils.data.DataLoader,
     test_loader: torch.utils.data.DataLoader,
     config: dict,
+    profiler: lib.profiling.Profiler = lib.profiling.DISABLED,
+    should_stop: Optional[Callable[[int, float], bool]] = None,
 ) -> Tuple[nn.Module, pd.DataFrame]:
     """Proceed to the actual learning of a ML model
 
+    The model is evaluated on the test data according to `eval_schedule`:
+    every `eval_every` steps ("steps"), every `eval_every` seconds ("time") or
+    at the end of each epoch ("epoch"). These intermediate evaluations use a
+    fixed random subsample of `eval_samples` test samples (0 for all of them),
+    the last point is always evaluated on the whole test data.
+
+    After each intermediate evaluation, `should_stop` is called with the number
+    of samples seen and the accuracy, and the training stops early if it
+    returns True.
+
     Args:
         model : the model
         train_loader : train data
         test_loader : test data
         config : a config file
+        profiler : times the data loading, training step and evaluation phases
+        should_stop : early stopping rule, e.g. sweep.MedianStopping
 
     Returns:
         The model with learnt parameters and its metrics
     """
     learning_rate = config["learning_rate"]
     n_iters = config["n_iters"]
+    eval_schedule = config.get("eval_schedule", "steps")
+    eval_every = config.get("eval_every", 5)
+    eval_loader = subsample_loader(
+        test_loader, config.get("eval_samples", 0), config["seed"]
+    )
 
+    net = setup_training(model, config)
     error = nn.CrossEntropyLoss()
     optimizer = torch.optim.SGD(model.parameters(), lr=learning_rate)
 
+    model.train()
     count = 0
-    loss_list = []
-    iteration_list = []
-    accuracy_list = []
-    for _ in range(n_iters):
-        for train_images, train_labels in train_loader:
-            optimizer.zero_grad()  # clear gradients
-            outputs = model(train_images)  # forward prop
-            loss = error(outputs, train_labels)  # entropy loss
-            loss.backward()  # compute gradients
-            optimizer.step()  # update parameters
+    metrics = []
+    start = time.perf_counter()
+    last_eval = {"time": start, "samples": 0}
+    samples = 0
+
+    def log(
+        loss: torch.Tensor, loader: torch.utils.data.DataLoader, report: bool = True
+    ) -> bool:
+        now = time.perf_counter()
+        with profiler.timer("eval"):
+            accuracy = compute_accuracy(net, loader, config)
+        metrics.append(
+            {
+                "iteration": count,
+                "loss": loss.item(),
+                "accuracy": accuracy,
+                "wall_time": now - start,
+                "samples_per_sec": (samples - last_eval["samples"])
+                / max(now - last_eval["time"], 1e-9),
+            }
+        )
+        # the evaluation itself is not counted in the throughput
+        last_eval["time"] = time.perf_counter()
+        last_eval["samples"] = samples
+        return report and should_stop is not None and should_stop(samples, accuracy)
 
+    loss = None
+    stop = False
+    for _ in range(n_iters):
+        for train_images, train_labels in profiler.iterate("data", train_loader):
+            loss = training_step(
+                net, train_images, train_labels, error, optimizer, config, profiler
+            )
             count += 1
-            if count % 5 == 0:
-                # compute accuracy on test sample
-                correct = 0
-                total = 0
-                for test_images, test_labels in test_loader:
-                    # Forward propagation
-                    outputs = model(test_images)
-                    predicted = torch.max(outputs.data, 1)[1]
-
-                    total += len(test_labels)
-                    correct += (predicted == test_labels).sum()
-
-                accuracy = 100 * correct / float(total)
-
-                loss_list.append(loss.data)
-                iteration_list.append(count)
-                accuracy_list.append(accuracy)
-
-    metrics = pd.DataFrame(
-        {"iteration": iteration_list, "loss": loss_list, "accuracy": accuracy_list}
-    )
+            samples += len(train_labels)
+            profiler.count("samples", len(train_labels))
+
+            if (eval_schedule == "steps" and count % eval_every == 0) or (
+                eval_schedule == "time"
+                and time.perf_counter() - last_eval["time"] >= eval_every
+            ):
+                stop = log(loss, eval_loader)
+                if stop:
+                    break
+        if not stop and eval_schedule == "epoch":
+            stop = log(loss, eval_loader)
+        profiler.flush(count)
+        if stop:
+            print(f"[INFO] Stopped early at iteration {count}")
+            break
+
+    if loss is not None:
+        log(loss, test_loader, report=False)
+    profiler.flush(count)
 
-    return model, metrics
+    return model, pd.DataFrame(metrics)
@@ -1,41 +1,296 @@
 """ Model RL related functions """
 
+import copy
 import os
+import pickle
 import random
 import string
+import time
+import zipfile
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Optional, Tuple
 
+import numpy as np
+import torch
 from gym_super_mario_bros.smb_env import SuperMarioBrosEnv
 from stable_baselines3 import PPO
 from stable_baselines3.common.base_class import BaseAlgorithm
 from stable_baselines3.common.callbacks import BaseCallback
+from stable_baselines3.common.save_util import recursive_getattr, save_to_zip_file
 
+import lib.profiling
 import lib.utils
 
+# bundle written at rollout boundaries to resume a training, see update_rl.py
+RESUME_FILE = "resume.zip"
+# entry of the bundle holding what SB3 does not save, ignored by PPO.load
+RESUME_STATE = "resume_state.pkl"
 
-class TrainCallback(BaseCallback):
-    """A callback during the training of a RL model."""
 
-    def __init__(
-        self, freq_to_save: int, save_path: str, n_calls: int = 0, verbose=1
+def get_rng_state() -> dict:
+    """Get the state of the random generators used during training.
+
+    Returns:
+        The states of the python, numpy and torch random generators
+    """
+    return {
+        "random": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+
+
+def set_rng_state(state: dict) -> None:
+    """Restore the random generators.
+
+    Args:
+        state : the states returned by get_rng_state
+    """
+    random.setstate(state["random"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+
+
+def load_resume(path: str, model_name: str, env: SuperMarioBrosEnv) -> BaseAlgorithm:
+    """Load a resume bundle, restoring the random generators.
+
+    Args:
+        path : path of the bundle
+        model_name : name of the model
+        env : environment to continue the training on
+
+    Returns:
+        The model, its num_timesteps being the timestep of the bundle
+    """
+    model = MODELS[model_name].load(path, env=env)
+    with zipfile.ZipFile(path) as archive:
+        state = pickle.loads(archive.read(RESUME_STATE))
+    set_rng_state(state["rng"])
+    return model
+
+
+def snapshot_model(model: BaseAlgorithm) -> Tuple[dict, dict, Optional[dict]]:
+    """Copy what BaseAlgorithm.save serializes, so that it can be written later.
+
+    Args:
+        model : the model
+
+    Returns:
+        The data, parameters and pytorch variables of the model
+    """
+    # same selection as BaseAlgorithm.save
+    data = model.__dict__.copy()
+    exclude = set(model._excluded_save_params())  # pylint: disable=W0212
+    save_params = model._get_torch_save_params()  # pylint: disable=W0212
+    state_dicts_names, torch_variable_names = save_params
+    for torch_var in state_dicts_names + torch_variable_names:
+        exclude.add(torch_var.split(".")[0])
+    for param_name in exclude:
+        data.pop(param_name, None)
+    pytorch_variables = None
+    if torch_variable_names:
+        pytorch_variables = {
+            name: recursive_getattr(model, name) for name in torch_variable_names
+        }
+    params = model.get_parameters()
+    return copy.deepcopy((data, params, pytorch_variables))
+
+
+class CheckpointWriter:
+    """Write model checkpoints from a background thread.
+
+    The model is snapshotted on the caller's thread and serialized on the
+    writer's, at most one checkpoint being in flight. Each checkpoint is written
+    to a temporary file then renamed, so a `model_<n>.zip` is never partial.
+    When `keep_last` > 0, only the last `keep_last` checkpoints are kept, plus
+    the first one of every `keep_every` timesteps if `keep_every` > 0.
+    """
+
+    def __init__(self, save_path: str, keep_last: int = 0, keep_every: int = 0):
+        self.save_path = save_path
+        self.keep_last = keep_last
+        self.keep_every = keep_every
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending: Optional[Future] = None
+
+    def save(
+        self, model: BaseAlgorithm, timesteps: int, extra_state: Optional[dict] = None
+    ) -> None:
+        """Snapshot a model and write it in the background.
+
+        Args:
+            model : the model
+            timesteps : global timestep of the model, used in the file name
+            extra_state : if given, the checkpoint is written as the resume
+                bundle with this state added to it
+        """
+        snapshot = snapshot_model(model)
+        self.wait()
+        self.pending = self.executor.submit(
+            self._write, snapshot, timesteps, copy.deepcopy(extra_state)
+        )
+
+    def wait(self) -> None:
+        """Wait for the checkpoint in flight, raising its error if any."""
+        if self.pending is not None:
+            self.pending.result()
+            self.pending = None
+
+    def close(self) -> None:
+        """Wait for the checkpoint in flight and stop the writer thread."""
+        self.wait()
+        self.executor.shutdown()
+
+    def _write(
+        self,
+        snapshot: Tuple[dict, dict, Optional[dict]],
+        timesteps: int,
+        extra_state: Optional[dict],
+    ) -> None:
+        """Write a snapshot atomically, then apply the retention policy.
+
+        Args:
+            snapshot : the snapshot of the model, see snapshot_model
+            timesteps : global timestep of the model
+            extra_state : state added to the resume bundle, None for a checkpoint
+        """
+        data, params, pytorch_variables = snapshot
+        file_name = f"model_{timesteps}.zip" if extra_state is None else RESUME_FILE
+        model_path = os.path.join(self.save_path, file_name)
+        with open(model_path + ".tmp", "w+b") as f:
+            save_to_zip_file(
+                f, data=data, params=params, pytorch_variables=pytorch_variables
+            )
+            if extra_state is not None:
+                with zipfile.ZipFile(f, mode="a") as archive:
+                    archive.writestr(RESUME_STATE, pickle.dumps(extra_state))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(model_path + ".tmp", model_path)
+        self._prune()
+
+    def _prune(self) -> None:
+        """Delete the checkpoints not kept by the retention policy."""
+        if not self.keep_last:
+            return
+        models = lib.utils.list_rl_models(self.save_path)
+        kept_buckets = set()
+        for step in sorted(models)[: -self.keep_last]:
+            if self.keep_every and step // self.keep_every not in kept_buckets:
+                kept_buckets.add(step // self.keep_every)
+                continue
+            os.remove(os.path.join(self.save_path, models[step]))
+
+
+class TrainCallback(BaseCallback):  # pylint: disable=R0902
+    """A callback during the training of a RL model.
+
+    Checkpoints are saved every `freq_to_save` global timesteps, i.e. summed over
+    all the environments of the VecEnv, and named after the global timestep.
+    They are written in the background with a retention policy, see
+    CheckpointWriter. At the start of the rollout following a checkpoint, when
+    the rollout buffer is empty, the resume bundle is written too. The env
+    steps/sec of each rollout is logged as `time/env_steps_per_sec`.
+
+    The profiler times each collection step (predict and env step), the
+    rollouts, the policy updates between them and the checkpoint snapshots,
+    and is flushed at the end of each rollout.
+
+    At the end of each rollout, `should_stop` is called with the global timestep
+    and the mean x_pos reached by the episodes finished during the rollout, and
+    the training stops early if it returns True.
+    """
+
+    def __init__(  # pylint: disable=R0913
+        self,
+        freq_to_save: int,
+        save_path: str,
+        keep_last: int = 0,
+        keep_every: int = 0,
+        verbose=1,
+        profiler: lib.profiling.Profiler = lib.profiling.DISABLED,
+        should_stop: Optional[Callable[[int, float], bool]] = None,
     ) -> None:
         super().__init__(verbose)
         self.freq_to_save = freq_to_save
-        self.save_path = save_path
-        self.n_calls = n_calls
+        self.writer = CheckpointWriter(save_path, keep_last, keep_every)
+        self.rollout_start_time = 0.0
+        self.rollout_start_timesteps = 0
+        self.resume_due = False
+        self.profiler = profiler
+        self.last_step_ns = 0
+        self.rollout_end_ns = 0
+        self.should_stop = should_stop
+        self.episodes_x_pos = []
+        self.stop = False
+
+    def _on_rollout_start(self) -> None:
+        now = time.perf_counter_ns()
+        if self.rollout_end_ns:
+            self.profiler.add("train", now - self.rollout_end_ns)
+        if self.resume_due:
+            with self.profiler.timer("checkpoint"):
+                self.writer.save(
+                    self.model, self.num_timesteps, {"rng": get_rng_state()}
+                )
+            self.resume_due = False
+        self.rollout_start_time = time.perf_counter()
+        self.rollout_start_timesteps = self.num_timesteps
+        self.last_step_ns = time.perf_counter_ns()
 
     def _on_step(self) -> bool:
-        if self.n_calls % self.freq_to_save == 0:
-            model_path = os.path.join(self.save_path, f"model_{self.n_calls}")
-            self.model.save(model_path)
-        return True
+        now = time.perf_counter_ns()
+        self.profiler.add("step", now - self.last_step_ns)
+        n_envs = self.training_env.num_envs
+        timesteps = self.num_timesteps
+        # a vectorized step moves n_envs timesteps at once, so save when a
+        # multiple of freq_to_save has been crossed rather than exactly hit
+        if timesteps // self.freq_to_save > (timesteps - n_envs) // self.freq_to_save:
+            with self.profiler.timer("checkpoint"):
+                self.writer.save(self.model, timesteps)
+            self.resume_due = True
+        if self.should_stop is not None:
+            for done, info in zip(self.locals["dones"], self.locals["infos"]):
+                if done:
+                    self.episodes_x_pos.append(info["x_pos"])
+        self.last_step_ns = time.perf_counter_ns()
+        return not self.stop
 
+    def _on_rollout_end(self) -> None:
+        elapsed = time.perf_counter() - self.rollout_start_time
+        steps = self.num_timesteps - self.rollout_start_timesteps
+        if elapsed > 0:
+            self.logger.record("time/env_steps_per_sec", steps / elapsed)
+        self.profiler.add("rollout", int(elapsed * 1e9))
+        self.profiler.count("env_steps", steps)
+        self.profiler.flush(self.num_timesteps)
+        if self.should_stop is not None and self.episodes_x_pos:
+            timesteps = self.num_timesteps
+            # SB3 only stops on a step returning False, i.e. the next rollout's
+            self.stop = self.should_stop(timesteps, np.mean(self.episodes_x_pos))
+            if self.stop:
+                print(f"[INFO] Stopping early at step {timesteps}")
+            self.episodes_x_pos = []
+        self.rollout_end_ns = time.perf_counter_ns()
 
-def learn(config: dict, env: SuperMarioBrosEnv) -> BaseAlgorithm:
+    def _on_training_end(self) -> None:
+        self.writer.close()
+
+
+def learn(
+    config: dict,
+    env: SuperMarioBrosEnv,
+    should_stop: Optional[Callable[[int, float], bool]] = None,
+) -> BaseAlgorithm:
     """Learn a RL model on an environment.
 
+    The training is profiled as described by the config, see
+    lib.profiling.profiler_from_config, under the name of its directory.
+
     Args:
         config : config parameters as a dict
         env : an environment
+        should_stop : early stopping rule, see TrainCallback
 
     Returns:
         A learnt RL model
@@ -45,7 +300,7 @@ def learn(config: dict, env: SuperMarioBrosEnv) -> BaseAlgorithm:
     freq_to_save = config["freq_to_save"]
     save_path = config["save_path"]
 
-    model = model_factory(model_name, env)
+    model = model_factory(model_name, env, config)
 
     dir_hash = "".join(random.choices(string.ascii_letters + string.digits, k=32))
     save_path = os.path.join(save_path, dir_hash)
@@ -53,29 +308,46 @@ def learn(config: dict, env: SuperMarioBrosEnv) -> BaseAlgorithm:
 
     lib.utils.dump_config(config, os.path.join(save_path, "config.yaml"))
 
-    model.learn(
-        total_timesteps=total_timesteps, callback=TrainCallback(freq_to_save, save_path)
-    )
+    with lib.profiling.profiler_from_config(config, dir_hash) as profiler:
+        model.learn(
+            total_timesteps=total_timesteps,
+            callback=TrainCallback(
+                freq_to_save,
+                save_path,
+                keep_last=config.get("keep_last", 0),
+                keep_every=config.get("keep_every", 0),
+                profiler=profiler,
+                should_stop=should_stop,
+            ),
+        )
+    return model
+
+
+MODELS = {"PPO": PPO}
 
 
-def model_factory(model_name: str, env: SuperMarioBrosEnv) -> BaseAlgorithm:
+def model_factory(
+    model_name: str, env: SuperMarioBrosEnv, config: Optional[dict] = None
+) -> BaseAlgorithm:
     """A factory of RL models.
 
     Args:
         model_name : name of the model
         env : environement for initializing the model
+        config : config parameters, for the learning_rate and n_steps of PPO
 
     Returns:
         The initialized model.
     """
+    config = config or {}
     factory = {
-        "PPO": PPO(
+        "PPO": lambda: PPO(
             "CnnPolicy",
             env,
             verbose=1,
             tensorboard_log="./logs/",
-            learning_rate=0.000001,
-            n_steps=512,
+            learning_rate=config.get("learning_rate", 0.000001),
+            n_steps=config.get("n_steps", 512),
         )
     }
-    return factory[model_name]
+    return factory[model_name]()
@@ -1,57 +1,155 @@
 """A method to play gym environments using human IO inputs."""
 import os
+import queue
 import random
 import string
+import threading
 import time
 from dataclasses import dataclass
-from typing import List
+from typing import Optional
 
 import gym
 import numpy as np
-import pandas as pd
 from nes_py._image_viewer import ImageViewer
 from pyglet import clock
 
+import lib.utils
+
 
 @dataclass
 class SaveCallback:
-    """A callback for saving the actions and states of an human run."""
+    """A callback for saving the actions and states of an human run.
+
+    Steps are buffered and written to disk every `chunk_size` steps, see
+    lib.utils.write_chunk, so that a long session neither holds all its frames
+    in memory nor loses them on a crash. Chunks are compressed and written by a
+    background thread; at most `max_pending` chunks wait for it, beyond that
+    the caller blocks. If a chunk cannot be written, the error is raised by the
+    next call or by close.
+
+    With `record_states` False only the actions are saved, along with the id
+    and seed of the environment: emulation being deterministic, the states are
+    regenerated on demand by replaying the actions, see lib.env.replay_runs.
+    """
 
     save_path: str
+    chunk_size: int = 1024
+    max_pending: int = 2
+    record_states: bool = True
+    env_id: str = "SuperMarioBros-v0"
+    seed: Optional[int] = None
 
     def __post_init__(self) -> None:
         """After __init__() tasks."""
         run_hash = "".join(random.choices(string.ascii_letters + string.digits, k=32))
         self.save_path = os.path.join(self.save_path, run_hash)
         os.makedirs(self.save_path, exist_ok=False)
-
-    def _save_actions(self, actions: List[int]) -> None:
-        """Save the actions in a txt file.
-
-        Args:
-            actions : actions done during all the steps
-        """
-        pd.DataFrame(actions).to_csv(
-            os.path.join(self.save_path, "actions.csv"), header=None, index=None
-        )
-
-    def _save_states(self, states: np.array) -> None:
-        """Save the states in a .npy file
+        meta = {"env_id": self.env_id, "record_states": self.record_states}
+        if self.seed is not None:
+            meta["seed"] = self.seed
+        meta_path = os.path.join(self.save_path, lib.utils.RUN_META_FILE)
+        lib.utils.dump_config(meta, meta_path)
+        self.n_chunks = 0
+        self.actions = []
+        self.states = []
+        self.pending = queue.Queue(maxsize=self.max_pending)
+        self.error = None
+        self.writer = threading.Thread(target=self._write_chunks, daemon=True)
+        self.writer.start()
+
+    def _write_chunks(self) -> None:
+        """Write the pending chunks until the None sentinel is received."""
+        while True:
+            chunk = self.pending.get()
+            if chunk is None:
+                return
+            if self.error is not None:
+                continue  # keep draining, not to block the caller
+            try:
+                lib.utils.write_chunk(self.save_path, *chunk)
+            except Exception as error:  # pylint: disable=W0703
+                self.error = error
+
+    def _check_writer(self) -> None:
+        """Raise the error of the writer thread, if any."""
+        if self.error is not None:
+            raise RuntimeError(
+                f"failed to write a chunk to {self.save_path}"
+            ) from self.error
+
+    def _save_chunk(self) -> None:
+        """Hand the buffered steps to the writer thread as a chunk."""
+        if not self.actions:
+            return
+        states = self.states if self.record_states else None
+        self.pending.put((self.n_chunks, states, self.actions))
+        self.n_chunks += 1
+        self.actions = []
+        self.states = []
+
+    def call(self, state: np.array, action: int) -> None:
+        """Save a step.
 
         Args:
-            states : states produced during all the steps
+            state : state observed before the action
+            action : action done at this step
         """
-        np.save(os.path.join(self.save_path, "states.npy"), states, allow_pickle=True)
-
-    def call(self, states: np.array, actions: List[int]) -> None:
-        """Save both actions and states.
+        self._check_writer()
+        if self.record_states:
+            self.states.append(state)
+        self.actions.append(action)
+        if len(self.actions) >= self.chunk_size:
+            self._save_chunk()
+
+    def close(self) -> None:
+        """Save the last steps and wait for all the chunks to be written."""
+        self._save_chunk()
+        self.pending.put(None)
+        self.writer.join()
+        self._check_writer()
+
+
+class FrameClock:
+    """Pace a loop at a fixed frame rate, sleeping until each frame deadline.
+
+    Frames whose deadline has already passed by a full frame are counted as
+    dropped, and the lateness of every frame is recorded as jitter.
+    """
 
-        Args:
-            states : states produced during all the steps
-            actions : actions done during all the steps
+    def __init__(self, fps: float) -> None:
+        self.frame_duration = 1 / fps
+        self.deadline = time.perf_counter()
+        self.n_frames = 0
+        self.n_dropped = 0
+        self.total_lateness = 0.0
+        self.max_lateness = 0.0
+
+    def wait(self) -> None:
+        """Sleep until the next frame deadline."""
+        now = time.perf_counter()
+        if now < self.deadline:
+            time.sleep(self.deadline - now)
+            now = time.perf_counter()
+        lateness = now - self.deadline
+        dropped = int(lateness // self.frame_duration)
+        self.n_frames += 1
+        self.n_dropped += dropped
+        self.total_lateness += lateness
+        self.max_lateness = max(self.max_lateness, lateness)
+        self.deadline += (dropped + 1) * self.frame_duration
+
+    def report(self) -> str:
+        """Summarize the frame timings.
+
+        Returns:
+            The number of frames, dropped frames and the jitter
         """
-        self._save_states(states)
-        self._save_actions(actions)
+        mean_lateness = self.total_lateness / max(self.n_frames, 1)
+        return (
+            f"{self.n_frames} frames played, {self.n_dropped} dropped, "
+            f"jitter mean {1000 * mean_lateness:.2f} ms "
+            f"max {1000 * self.max_lateness:.2f} ms"
+        )
 
 
 # the sentinel value for "No Operation"
@@ -64,7 +162,7 @@ def play_human(env: gym.Env, callback=None) -> None:  # pylint: disable=R0914
 
     Args:
         env: the initialized gym environment to play
-        callback: a callback to receive output from the environment
+        callback: a callback receiving each (state, action) step, see SaveCallback
 
     Returns:
         None
@@ -95,20 +193,12 @@ def play_human(env: gym.Env, callback=None) -> None:  # pylint: disable=R0914
     # create a done flag for the environment
     done = True
     # prepare frame rate limiting
-    target_frame_duration = 1 / env.metadata["video.frames_per_second"]
-    last_frame_time = 0
-    # Init storing objects
-    actions = []
-    states = []
+    frame_clock = FrameClock(env.metadata["video.frames_per_second"])
     # start the main game loop
     try:
         while True:
-            current_frame_time = time.time()
             # limit frame rate
-            if last_frame_time + target_frame_duration > current_frame_time:
-                continue
-            # save frame beginning time for next refresh
-            last_frame_time = current_frame_time
+            frame_clock.wait()
             # clock tick
             clock.tick()
             # reset if the environment is done
@@ -118,19 +208,21 @@ def play_human(env: gym.Env, callback=None) -> None:  # pylint: disable=R0914
                 viewer.show(env.unwrapped.screen)
             # unwrap the action based on pressed relevant keys
             action = keys_to_action.get(viewer.pressed_keys, _NOP)
-            actions.append(action)
-            states.append(state)
+            if callback is not None:
+                callback.call(state, action)
             next_state, _, done, _ = env.step(action)
             viewer.show(env.unwrapped.screen)
             state = next_state
             # shutdown if the escape key is pressed
             if viewer.is_escape_pressed:
                 break
-        if callback is not None:
-            callback(states, actions)
     except KeyboardInterrupt:
         pass
+    finally:
+        if callback is not None:
+            callback.close()
 
+    print(f"[INFO] {frame_clock.report()}")
     viewer.close()
     env.close()
 
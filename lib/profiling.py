@@ -0,0 +1,349 @@
+""" Timers and counters to see where the time goes
+
+Phases are timed with named timers, e.g. `with profiler.timer("step"):`, and
+events counted with named counters. Durations are accumulated in histograms
+of power of 2 buckets, so that a timer costs about a microsecond whatever the
+length of the run. The statistics are written to sinks: a CSV file, tensorboard
+or a summary on stdout.
+
+A disabled profiler, the default everywhere, hands out a shared no-op timer.
+
+For a function level view, the profiler can also run cProfile and dump its
+stats to a .prof file (`python -m pstats`, snakeviz). Sampling profilers such as
+py-spy need nothing: the timed phases show up under their own functions.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import cProfile
+import os
+import time
+from typing import TYPE_CHECKING, Iterable, Iterator, List, Optional
+
+import numpy as np
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+# bucket b holds the durations of b bits in ns, the last one is up to ~9 min
+N_BUCKETS = 40
+
+
+class Stat:
+    """The count, total, max and histogram of the durations of a timer."""
+
+    __slots__ = ("count", "total", "max", "buckets")
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.buckets = [0] * N_BUCKETS
+
+    def add(self, duration: int) -> None:
+        """Add a duration.
+
+        Args:
+            duration : a duration in ns
+        """
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+        self.buckets[min(duration.bit_length(), N_BUCKETS - 1)] += 1
+
+    def quantile(self, q: float) -> int:
+        """Estimate a quantile of the durations from the histogram.
+
+        Args:
+            q : the quantile, between 0 and 1
+
+        Returns:
+            The upper bound of the bucket holding the quantile, in ns
+        """
+        rank = np.searchsorted(np.cumsum(self.buckets), q * self.count)
+        return min(2 ** int(rank), self.max)
+
+
+class Timer:
+    """Add the duration of a with block to a Stat. Not reentrant."""
+
+    __slots__ = ("stat", "start")
+
+    def __init__(self, stat: Stat) -> None:
+        self.stat = stat
+        self.start = 0
+
+    def __enter__(self) -> "Timer":
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.stat.add(time.perf_counter_ns() - self.start)
+
+
+class StdoutSink:
+    """Print the statistics at the end of the run."""
+
+    def write(self, summary: pd.DataFrame, step: int, final: bool) -> None:
+        """Write the statistics.
+
+        Args:
+            summary : the statistics, see Profiler.summary
+            step : the step they were collected up to
+            final : whether the run is over
+        """
+        if final:
+            print(f"[INFO] Profile after {step} steps")
+            print(summary.to_string(index=False))
+
+
+class CSVSink:
+    """Append the statistics to a CSV file, one row per timer or counter."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def write(self, summary: pd.DataFrame, step: int, final: bool) -> None:
+        """Write the statistics, see StdoutSink.write"""
+        summary = summary.assign(step=step, final=final)
+        summary.to_csv(
+            self.path, mode="a", header=not os.path.exists(self.path), index=False
+        )
+
+
+class TensorboardSink:
+    """Log the statistics to tensorboard, under profile/."""
+
+    def __init__(self, log_dir: str) -> None:
+        # only needed by this sink
+        from torch.utils.tensorboard import SummaryWriter  # pylint: disable=C0415
+
+        self.writer = SummaryWriter(log_dir)
+
+    def write(self, summary: pd.DataFrame, step: int, final: bool) -> None:
+        """Write the statistics, see StdoutSink.write"""
+        for row in summary.itertuples():
+            if row.kind == "counter":
+                self.writer.add_scalar(f"profile/{row.name}", row.count, step)
+            else:
+                self.writer.add_scalar(f"profile/{row.name}_mean_ms", row.mean_ms, step)
+                self.writer.add_scalar(f"profile/{row.name}_p99_ms", row.p99_ms, step)
+                self.writer.add_scalar(f"profile/{row.name}_total_s", row.total_s, step)
+        self.writer.flush()
+        if final:
+            self.writer.close()
+
+
+class Profiler:  # pylint: disable=R0902
+    """Named timers and counters, written to sinks.
+
+    Example:
+        with profiler:
+            for _ in range(n):
+                with profiler.timer("step"):
+                    env.step(action)
+                profiler.count("steps")
+            profiler.flush(n)
+    """
+
+    def __init__(
+        self,
+        sinks: Optional[List[object]] = None,
+        cprofile_path: Optional[str] = None,
+    ) -> None:
+        """
+        Args:
+            sinks : where to write the statistics, disabled if None or empty
+            cprofile_path : path of the cProfile stats, no cProfile if None
+        """
+        self.sinks = sinks or []
+        self.enabled = bool(self.sinks)
+        self.cprofile_path = cprofile_path
+        self.cprofile = None
+        self.stats = {}
+        self.timers = {}
+        self.counters = {}
+        self.last_step = 0
+
+    def timer(self, name: str) -> contextlib.AbstractContextManager:
+        """Get the timer of a phase, to use as `with profiler.timer(name):`
+
+        Args:
+            name : name of the phase
+
+        Returns:
+            The timer, a no-op if the profiler is disabled
+        """
+        if not self.enabled:
+            return NULL_TIMER
+        timer = self.timers.get(name)
+        if timer is None:
+            timer = self.timers[name] = Timer(self.stats.setdefault(name, Stat()))
+        return timer
+
+    def add(self, name: str, duration: int) -> None:
+        """Add a duration measured by the caller to the timer of a phase.
+
+        Args:
+            name : name of the phase
+            duration : the duration in ns
+        """
+        if self.enabled:
+            self.stats.setdefault(name, Stat()).add(duration)
+
+    def count(self, name: str, n: int = 1) -> None:
+        """Increment a counter.
+
+        Args:
+            name : name of the counter
+            n : increment
+        """
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def iterate(self, name: str, iterable: Iterable) -> Iterator:
+        """Iterate while timing how long each item takes to come.
+
+        Args:
+            name : name of the phase
+            iterable : e.g. a DataLoader
+
+        Returns:
+            An iterator over the items of the iterable
+        """
+        if not self.enabled:
+            return iter(iterable)
+        return self._iterate(self.timer(name), iterable)
+
+    @staticmethod
+    def _iterate(timer: Timer, iterable: Iterable) -> Iterator:
+        iterator = iter(iterable)
+        while True:
+            with timer:
+                item = next(iterator, StopIteration)
+            if item is StopIteration:
+                return
+            yield item
+
+    def summary(self) -> pd.DataFrame:
+        """Summarize the timers and counters.
+
+        Returns:
+            One row per timer (count, total, mean, quantiles and max duration)
+            and per counter (count)
+        """
+        import pandas as pd  # pylint: disable=C0415
+
+        rows = [
+            {
+                "name": name,
+                "kind": "timer",
+                "count": stat.count,
+                "total_s": stat.total / 1e9,
+                "mean_ms": stat.total / max(stat.count, 1) / 1e6,
+                "p50_ms": stat.quantile(0.5) / 1e6,
+                "p99_ms": stat.quantile(0.99) / 1e6,
+                "max_ms": stat.max / 1e6,
+            }
+            for name, stat in self.stats.items()
+        ]
+        rows += [
+            {"name": name, "kind": "counter", "count": count}
+            for name, count in self.counters.items()
+        ]
+        return pd.DataFrame(
+            rows,
+            columns=[
+                "name",
+                "kind",
+                "count",
+                "total_s",
+                "mean_ms",
+                "p50_ms",
+                "p99_ms",
+                "max_ms",
+            ],
+        )
+
+    def flush(self, step: int, final: bool = False) -> None:
+        """Write the statistics collected so far to the sinks.
+
+        Args:
+            step : the step they were collected up to, e.g. the iteration
+            final : whether the run is over
+        """
+        self.last_step = step
+        if not self.enabled:
+            return
+        summary = self.summary()
+        for sink in self.sinks:
+            sink.write(summary, step, final)
+
+    def __enter__(self) -> "Profiler":
+        if self.cprofile_path is not None:
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        if self.cprofile is not None:
+            self.cprofile.disable()
+            self.cprofile.dump_stats(self.cprofile_path)
+            print(f"[INFO] cProfile stats written to {self.cprofile_path}")
+            self.cprofile = None
+        self.flush(self.last_step, final=True)
+
+
+NULL_TIMER = contextlib.nullcontext()
+# the profiler of functions called without one
+DISABLED = Profiler()
+
+
+def create_profiler(
+    sinks: str, path: str, name: str, cprofile: bool = False
+) -> Profiler:
+    """Create a profiler writing to some sinks.
+
+    Args:
+        sinks : comma separated sinks among "stdout", "csv" and "tensorboard",
+            the profiler is disabled if empty
+        path : directory of the CSV file, tensorboard logs and cProfile stats
+        name : name of the profiled run, used to name the files
+        cprofile : whether to run cProfile too
+
+    Returns:
+        The profiler
+    """
+    factories = {
+        "stdout": StdoutSink,
+        "csv": lambda: CSVSink(os.path.join(path, f"{name}.csv")),
+        "tensorboard": lambda: TensorboardSink(os.path.join(path, name)),
+    }
+    sinks = [s.strip() for s in sinks.split(",") if s.strip()]
+    if sinks or cprofile:
+        os.makedirs(path, exist_ok=True)
+    return Profiler(
+        [factories[s]() for s in sinks],
+        os.path.join(path, f"{name}.prof") if cprofile else None,
+    )
+
+
+def profiler_from_config(config: dict, name: str) -> Profiler:
+    """Create the profiler described by the `profile`, `profile_path` and
+    `profile_calls` keys of a config, see create_profiler.
+
+    Args:
+        config : config parameters as a dict
+        name : name of the profiled run
+
+    Returns:
+        The profiler
+    """
+    return create_profiler(
+        config.get("profile", ""),
+        config.get("profile_path", "./logs/profile/"),
+        name,
+        config.get("profile_calls", False),
+    )
@@ -0,0 +1,452 @@
+""" A policy server batching the predictions of many emulator processes
+
+The server process loads the model once. Each client owns `width` slots of a
+shared memory block: it writes its observations there, sends a request (its
+index and number of observations) through a queue and waits on its semaphore.
+The server coalesces the requests that arrive within `deadline_ms` of the
+first one, up to `max_batch` observations, predicts the actions of the whole
+batch at once, writes them next to the observations and wakes the clients up.
+If the server process dies, e.g. failing to load the model, the waiting
+processes raise instead of waiting for it forever.
+
+Only the server process imports the model's stack (torch, stable_baselines3),
+when loading it, not the clients.
+"""
+
+from __future__ import annotations
+
+import multiprocessing
+import os
+import queue
+import time
+from multiprocessing import shared_memory
+from typing import TYPE_CHECKING, List, Optional, Tuple
+
+import gym_super_mario_bros.actions
+import numpy as np
+
+import lib.env
+import lib.utils
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+# how often, in seconds, the waiting processes check that the server is alive
+POLL_INTERVAL_S = 1.0
+
+
+def load_policy(model_path: str):
+    """Load a model saved by train_ml.py (.pyt) or train_rl.py (.zip), or a
+    policy exported by export_model.py (.pt or .onnx), on CPU.
+
+    Args:
+        model_path : path of the model, next to the config.yaml of its training
+
+    Returns:
+        The model, whose predict takes a batch of stacked observations
+    """
+    # pylint: disable=C0415
+    if model_path.endswith((".pt", ".onnx")):
+        from lib import export
+
+        return export.load_exported(model_path)
+    if model_path.endswith(".zip"):
+        from stable_baselines3 import PPO
+
+        return PPO.load(model_path, device="cpu")
+    from lib import model_ml
+
+    config = lib.utils.load_config(
+        os.path.join(os.path.dirname(model_path), "config.yaml")
+    )
+    height, width, stacks = lib.env.observation_shape(config)
+    return model_ml.load_model(
+        model_path,
+        config,
+        len(gym_super_mario_bros.actions.SIMPLE_MOVEMENT),
+        (stacks, height, width),
+    )
+
+
+def attach(name: str) -> shared_memory.SharedMemory:
+    """Attach to a shared memory block created by the PolicyServer.
+
+    Args:
+        name : name of the block
+
+    Returns:
+        The block
+    """
+    # the processes started by PolicyServer share the resource tracker of its
+    # process, which already tracks the block: attaching registers it again as
+    # the same entry, and PolicyServer.close unregisters it when unlinking it
+    return shared_memory.SharedMemory(name=name)
+
+
+def slot_arrays(
+    shm: shared_memory.SharedMemory, n_slots: int, obs_shape: Tuple[int, ...]
+) -> Tuple[np.array, np.array]:
+    """View a shared memory block as its observation and action slots.
+
+    Args:
+        shm : the block
+        n_slots : number of slots
+        obs_shape : shape of an observation
+
+    Returns:
+        The observations and the actions
+    """
+    observations = np.ndarray((n_slots, *obs_shape), dtype=np.uint8, buffer=shm.buf)
+    offset = -(-observations.nbytes // 8) * 8  # aligned for the int64 actions
+    actions = np.ndarray((n_slots,), dtype=np.int64, buffer=shm.buf, offset=offset)
+    return observations, actions
+
+
+def block_size(n_slots: int, obs_shape: Tuple[int, ...]) -> int:
+    """Get the size of the shared memory block, see slot_arrays"""
+    return -(-n_slots * int(np.prod(obs_shape)) // 8) * 8 + n_slots * 8
+
+
+def serve(  # pylint: disable=R0913,R0914
+    model_path: str,
+    shm_name: str,
+    obs_shape: Tuple[int, ...],
+    width: int,
+    requests: multiprocessing.Queue,
+    semaphores: List[multiprocessing.Semaphore],
+    stopped: multiprocessing.Event,
+    max_batch: int,
+    deadline_ms: float,
+) -> None:
+    """Serve the predictions until the None request, in the server process.
+
+    Args:
+        model_path : path of the model, see load_policy
+        shm_name : name of the shared memory block
+        obs_shape : shape of an observation
+        width : number of slots of each client
+        requests : queue of the (client, number of observations) requests
+        semaphores : semaphore of each client, released once its actions are set
+        stopped : set if the server fails, for the clients not to wait for it
+        max_batch : maximum number of observations in a batch
+        deadline_ms : how long to wait for other requests after the first one
+    """
+    try:
+        model = load_policy(model_path)
+        shm = attach(shm_name)
+        observations, actions = slot_arrays(shm, len(semaphores) * width, obs_shape)
+        n_batches, n_observations = 0, 0
+        stop = False
+        while not stop:
+            request = requests.get()
+            if request is None:
+                break
+            batch = [request]
+            size = request[1]
+            deadline = time.perf_counter() + deadline_ms / 1000
+            while size < max_batch:
+                try:
+                    request = requests.get(
+                        timeout=max(deadline - time.perf_counter(), 0)
+                    )
+                except queue.Empty:
+                    break
+                if request is None:
+                    stop = True
+                    break
+                batch.append(request)
+                size += request[1]
+            idx = np.concatenate(
+                [np.arange(client * width, client * width + n) for client, n in batch]
+            )
+            actions[idx], _ = model.predict(observations[idx])
+            for client, _ in batch:
+                semaphores[client].release()
+            n_batches += 1
+            n_observations += size
+        if n_batches:
+            print(
+                f"[INFO] Served {n_observations} observations in {n_batches} batches "
+                f"of {n_observations / n_batches:.1f} on average"
+            )
+        shm.close()
+    except Exception:
+        stopped.set()
+        raise
+
+
+class RemotePolicy:  # pylint: disable=R0902
+    """A client of the PolicyServer, with the predict method of the models.
+
+    It must be handed to the processes using it as an argument of their
+    creation, see PolicyServer.client. Not thread-safe: each thread or process
+    needs its own client.
+    """
+
+    def __init__(  # pylint: disable=R0913
+        self,
+        shm_name: str,
+        obs_shape: Tuple[int, ...],
+        n_slots: int,
+        client: int,
+        width: int,
+        requests: multiprocessing.Queue,
+        semaphore: multiprocessing.Semaphore,
+        stopped: multiprocessing.Event,
+    ) -> None:
+        self.shm_name = shm_name
+        self.obs_shape = obs_shape
+        self.n_slots = n_slots
+        self.client = client
+        self.width = width
+        self.requests = requests
+        self.semaphore = semaphore
+        self.stopped = stopped
+        self.shm = None
+        self.observations = None
+        self.actions = None
+
+    def __getstate__(self) -> dict:
+        # the shared memory is attached again in the process unpickling
+        return {**self.__dict__, "shm": None, "observations": None, "actions": None}
+
+    def predict(self, state: np.array) -> Tuple[np.array, None]:
+        """Predict the actions given a batch of states, on the server
+
+        Args:
+            state : a batch of at most `width` stacked observations
+
+        Returns:
+            The actions and None, as PPO.predict and CNNModel.predict
+        """
+        if self.shm is None:
+            self.shm = attach(self.shm_name)
+            self.observations, self.actions = slot_arrays(
+                self.shm, self.n_slots, self.obs_shape
+            )
+        n = len(state)
+        if n > self.width:
+            raise ValueError(f"{n} observations for {self.width} slots per client")
+        start = self.client * self.width
+        self.observations[start : start + n] = state
+        self.requests.put((self.client, n))
+        while not self.semaphore.acquire(timeout=POLL_INTERVAL_S):
+            if self.stopped.is_set():
+                raise RuntimeError("the policy server stopped")
+        return self.actions[start : start + n].copy(), None
+
+
+class PolicyServer:  # pylint: disable=R0902
+    """Run the policy server in its own process, see the module docstring.
+
+    Example:
+        with PolicyServer(model_path, (84, 84, 4), n_clients=16) as server:
+            clients = [server.client(i) for i in range(16)]
+    """
+
+    def __init__(  # pylint: disable=R0913
+        self,
+        model_path: str,
+        obs_shape: Tuple[int, ...],
+        n_clients: int,
+        width: int = 1,
+        max_batch: int = 64,
+        deadline_ms: float = 2.0,
+    ) -> None:
+        """
+        Args:
+            model_path : path of the model, see load_policy
+            obs_shape : shape of a stacked observation
+            n_clients : number of clients
+            width : number of observations per request of a client, i.e. the
+                number of emulators of its VecEnv
+            max_batch : maximum number of observations in a batch
+            deadline_ms : how long to wait for other requests after the first one
+        """
+        self.obs_shape = tuple(obs_shape)
+        self.width = width
+        self.n_slots = n_clients * width
+        self.context = multiprocessing.get_context("forkserver")
+        self.shm = shared_memory.SharedMemory(
+            create=True, size=block_size(self.n_slots, self.obs_shape)
+        )
+        self.requests = self.context.Queue()
+        self.semaphores = [self.context.Semaphore(0) for _ in range(n_clients)]
+        self.stopped = self.context.Event()
+        self.process = self.context.Process(
+            target=serve,
+            args=(
+                model_path,
+                self.shm.name,
+                self.obs_shape,
+                width,
+                self.requests,
+                self.semaphores,
+                self.stopped,
+                max_batch,
+                deadline_ms,
+            ),
+            daemon=True,
+        )
+        self.process.start()
+
+    def client(self, index: int) -> RemotePolicy:
+        """Get the client of a given index, to hand to the process using it.
+
+        Args:
+            index : index of the client, from 0 to n_clients - 1
+
+        Returns:
+            The client
+        """
+        return RemotePolicy(
+            self.shm.name,
+            self.obs_shape,
+            self.n_slots,
+            index,
+            self.width,
+            self.requests,
+            self.semaphores[index],
+            self.stopped,
+        )
+
+    def check(self) -> None:
+        """Raise a RuntimeError if the server process exited, e.g. failing to
+        load the model.
+        """
+        if not self.process.is_alive():
+            self.stopped.set()
+            raise RuntimeError(
+                f"the policy server exited with code {self.process.exitcode}"
+            )
+
+    def close(self) -> None:
+        """Stop the server and free the shared memory."""
+        self.requests.put(None)
+        self.process.join()
+        self.stopped.set()
+        self.shm.close()
+        self.shm.unlink()
+
+    def __enter__(self) -> "PolicyServer":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def _evaluate_client(  # pylint: disable=R0913
+    policy: RemotePolicy,
+    config: dict,
+    n_episodes: int,
+    stages: Optional[List[str]],
+    n_envs: int,
+    max_steps: Optional[int],
+    results: multiprocessing.Queue,
+) -> None:
+    """Evaluate the served model in a client process, see lib.env.evaluate"""
+    episodes, stats = lib.env.evaluate(
+        policy,
+        config,
+        n_episodes,
+        stages=stages,
+        n_envs=n_envs,
+        vec_env="dummy",
+        max_steps=max_steps,
+    )
+    results.put((episodes, stats))
+
+
+def _get_result(
+    results: multiprocessing.Queue,
+    server: PolicyServer,
+    processes: List[multiprocessing.Process],
+) -> Tuple[pd.DataFrame, dict]:
+    """Get the result of a client process, see evaluate_served. Raise a
+    RuntimeError if the server or a client process exited without one.
+    """
+    while True:
+        try:
+            return results.get(timeout=POLL_INTERVAL_S)
+        except queue.Empty:
+            server.check()
+            for process in processes:
+                if process.exitcode not in (None, 0):
+                    raise RuntimeError(
+                        f"a client process exited with code {process.exitcode}"
+                    ) from None
+
+
+def client_config(config: dict, offset: int) -> dict:
+    """Offset the seed of a config, for the emulators of a client not to replay
+    those of another one.
+
+    Args:
+        config : config parameters
+        offset : offset of the seed
+
+    Returns:
+        The config with the offset seed
+    """
+    if config.get("seed") is None:
+        return config
+    return {**config, "seed": config["seed"] + offset}
+
+
+def evaluate_served(  # pylint: disable=R0913,R0914
+    model_path: str,
+    config: dict,
+    n_episodes: int,
+    n_clients: int,
+    stages: Optional[List[str]] = None,
+    n_envs: int = 1,
+    max_steps: Optional[int] = None,
+) -> Tuple[pd.DataFrame, dict]:
+    """Evaluate a model with many emulator processes sharing a policy server.
+
+    Each of the `n_clients` processes steps `n_envs` emulators, seeded apart
+    from those of the other processes, and plays its share of the episodes, see
+    lib.env.evaluate.
+
+    Args:
+        model_path : path of the model, see load_policy
+        config : config parameters the model was trained with
+        n_episodes : number of episodes to play
+        n_clients : number of emulator processes
+        stages : stages to play as "<world>-<stage>", the whole game if None
+        n_envs : number of emulators per process
+        max_steps : number of steps after which an episode is truncated
+
+    Returns:
+        The episodes (stage, x_pos, flag_get, steps) and aggregated statistics
+    """
+    obs_shape = lib.env.observation_shape(config)
+    with PolicyServer(model_path, obs_shape, n_clients, width=n_envs) as server:
+        results = server.context.Queue()
+        processes = [
+            server.context.Process(
+                target=_evaluate_client,
+                args=(
+                    server.client(i),
+                    client_config(config, i * n_envs),
+                    (n_episodes + i) // n_clients,
+                    stages,
+                    n_envs,
+                    max_steps,
+                    results,
+                ),
+            )
+            for i in range(n_clients)
+            if (n_episodes + i) // n_clients
+        ]
+        for process in processes:
+            process.start()
+        outputs = [_get_result(results, server, processes) for _ in processes]
+        for process in processes:
+            process.join()
+
+    import pandas as pd  # pylint: disable=C0415
+
+    episodes = pd.concat([e for e, _ in outputs], ignore_index=True)
+    steps_per_sec = sum(s["steps_per_sec"] for _, s in outputs)
+    return episodes, lib.env.episode_stats(episodes, steps_per_sec)
@@ -1,17 +1,26 @@
-""" Utils functions """
+""" Utils functions
 
-import functools
+The heavy dependencies (torch, cv2, pandas, matplotlib, sklearn) are imported
+by the functions using them, so that the scripts only needing e.g. load_config
+or get_max_step_rl_model start quickly.
+"""
+
+from __future__ import annotations
+
+import hashlib
 import os
+import queue
 import re
-from typing import List, Tuple
+import shutil
+import threading
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple, Union
 
-import cv2
 import numpy as np
-import pandas as pd
-import torch
 import yaml
-from matplotlib import pyplot as plt
-from sklearn.model_selection import train_test_split
+
+if TYPE_CHECKING:
+    import torch
 
 
 def load_config(path: str) -> dict:
@@ -25,12 +34,61 @@ def load_config(path: str) -> dict:
     """
     with open(path, encoding="utf-8") as f:
         config = yaml.load(f, Loader=yaml.BaseLoader)
+    return cast_config(config)
+
+
+def cast_config(config: dict) -> dict:
+    """Cast the config parameters read as strings to their types
+
+    Parameters already cast are left as is.
+
+    Args:
+        config : the config parameters
 
+    Returns:
+        The config parameters cast
+    """
     config = conf_param_to_int(
         config,
-        ["stacks", "seed", "total_timesteps", "freq_to_save", "batch_size", "n_iters"],
+        [
+            "stacks",
+            "seed",
+            "total_timesteps",
+            "freq_to_save",
+            "batch_size",
+            "n_iters",
+            "n_envs",
+            "crop_top",
+            "resize",
+            "frame_skip",
+            "num_threads",
+            "eval_every",
+            "eval_samples",
+            "num_workers",
+            "prefetch_factor",
+            "augment",
+            "keep_last",
+            "keep_every",
+            "snapshot_every",
+            "snapshot_redraw_every",
+            "n_steps",
+        ],
+    )
+    config = conf_param_to_float(
+        config, ["learning_rate", "test_size", "snapshot_probability"]
+    )
+    config = conf_param_to_bool(
+        config,
+        [
+            "channels_last",
+            "compile",
+            "shuffle",
+            "pin_memory",
+            "persistent_workers",
+            "record_states",
+            "profile_calls",
+        ],
     )
-    config = conf_param_to_float(config, ["learning_rate", "test_size"])
     return config
 
 
@@ -66,6 +124,22 @@ def conf_param_to_float(config: dict, keys: List[str]) -> dict:
     return config
 
 
+def conf_param_to_bool(config: dict, keys: List[str]) -> dict:
+    """Cast config parameters as bool
+
+    Args:
+        config : the config parameters
+        keys : parameters to cast as bool
+
+    Returns:
+        The config parameters with the desired ones cast as bool
+    """
+    for key in keys:
+        if key in config:
+            config[key] = str(config[key]).lower() == "true"
+    return config
+
+
 def dump_config(config: dict, path: str) -> None:
     """Dump the config parameters o a yaml file
 
@@ -77,6 +151,47 @@ def dump_config(config: dict, path: str) -> None:
         yaml.dump(config, f)
 
 
+def preprocess_frame(frame: np.array, crop_top: int = 0, resize: int = 0) -> np.array:
+    """Crop the HUD off a grayscale frame and downsample it.
+
+    Args:
+        frame : a grayscale frame of shape (height, width, 1)
+        crop_top : number of rows removed at the top of the frame
+        resize : side of the square output frame, 0 to keep the size
+
+    Returns:
+        The preprocessed frame of shape (height, width, 1)
+    """
+    frame = frame[crop_top:]
+    if resize:
+        import cv2  # pylint: disable=C0415
+
+        frame = cv2.resize(  # pylint: disable=E1101
+            frame,
+            (resize, resize),
+            interpolation=cv2.INTER_AREA,  # pylint: disable=E1101
+        )
+    return frame.reshape(frame.shape[0], frame.shape[1], 1)
+
+
+def preprocessed_shape(
+    shape: Tuple[int, ...], crop_top: int = 0, resize: int = 0
+) -> Tuple[int, int, int]:
+    """Shape of a frame after preprocess_frame
+
+    Args:
+        shape : shape of the grayscale frame
+        crop_top : number of rows removed at the top of the frame
+        resize : side of the square output frame, 0 to keep the size
+
+    Returns:
+        The shape of the preprocessed frame
+    """
+    if resize:
+        return (resize, resize, 1)
+    return (shape[0] - crop_top, shape[1], 1)
+
+
 def save_frame_seq(state: np.array, path: str) -> None:
     """Save a frame from a stacked environement in png.
 
@@ -84,6 +199,8 @@ def save_frame_seq(state: np.array, path: str) -> None:
         state : a frame of a stacked environment
         path : path of the file
     """
+    from matplotlib import pyplot as plt  # pylint: disable=C0415
+
     plt.figure(figsize=(20, 16))
     for idx in range(state.shape[3]):
         plt.subplot(1, 4, idx + 1)
@@ -98,6 +215,8 @@ def save_frame(state: np.array, path: str) -> None:
         state : a frame of an environment
         path : path of the file
     """
+    from matplotlib import pyplot as plt  # pylint: disable=C0415
+
     plt.figure()
     plt.imshow(state)
     plt.savefig(path)
@@ -122,117 +241,762 @@ def states_to_mp4(states: np.array, out_path: str):
         states : a sequence of frames
         out_path : path to export
     """
-    size = (states.shape[1], states.shape[2])
-    fps = 60
-    out = cv2.VideoWriter(  # pylint: disable=E1101
-        out_path,
-        cv2.VideoWriter_fourcc(*"mp4v"),  # pylint: disable=E1101
-        fps,
-        (size[1], size[0]),
-        False,
+    with VideoSink(out_path) as sink:
+        for state in states:
+            sink.write(state)
+
+
+class VideoSink:  # pylint: disable=R0902
+    """Encode grayscale frames to a video as they are produced.
+
+    Frames are handed to a background thread through a queue of at most
+    `max_pending` frames, beyond that the caller blocks, so that the memory used
+    does not depend on the length of the video. Only one frame every `every` is
+    kept, the frame rate is divided accordingly so that the video plays at the
+    speed of the game, and frames are downscaled by `scale`. If a frame cannot
+    be encoded, the error is raised by the next write or by close.
+
+    Example:
+        with lib.utils.VideoSink("run.mp4", every=2) as sink:
+            lib.env.run(env, model, sink=sink)
+    """
+
+    def __init__(  # pylint: disable=R0913
+        self,
+        out_path: str,
+        fps: float = 60,
+        every: int = 1,
+        scale: float = 1.0,
+        max_pending: int = 64,
+    ) -> None:
+        """
+        Args:
+            out_path : path to export
+            fps : frame rate of the frames written
+            every : keep one frame every `every`
+            scale : scale factor of the frames
+            max_pending : maximum number of frames waiting to be encoded
+        """
+        self.out_path = out_path
+        self.fps = fps / every
+        self.every = every
+        self.scale = scale
+        self.n_frames = 0
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.encoder = threading.Thread(target=self._encode_frames, daemon=True)
+        self.encoder.start()
+
+    def _encode_frames(self) -> None:
+        """Encode the pending frames until the None sentinel is received."""
+        import cv2  # pylint: disable=C0415
+
+        out = None
+        while True:
+            frame = self.pending.get()
+            if frame is None:
+                break
+            if self.error is not None:
+                continue  # keep draining, not to block the caller
+            try:
+                if self.scale != 1.0:
+                    frame = cv2.resize(  # pylint: disable=E1101
+                        frame,
+                        None,
+                        fx=self.scale,
+                        fy=self.scale,
+                        interpolation=cv2.INTER_AREA,  # pylint: disable=E1101
+                    )
+                if out is None:
+                    out = cv2.VideoWriter(  # pylint: disable=E1101
+                        self.out_path,
+                        cv2.VideoWriter_fourcc(*"mp4v"),  # pylint: disable=E1101
+                        self.fps,
+                        (frame.shape[1], frame.shape[0]),
+                        False,
+                    )
+                out.write(frame)
+            except Exception as error:  # pylint: disable=W0703
+                self.error = error
+        if out is not None:
+            out.release()
+
+    def _check_encoder(self) -> None:
+        """Raise the error of the encoder thread, if any."""
+        if self.error is not None:
+            raise RuntimeError(f"failed to encode {self.out_path}") from self.error
+
+    def write(self, frame: np.array) -> None:
+        """Add a frame to the video.
+
+        Args:
+            frame : a grayscale frame of shape (height, width)
+        """
+        self._check_encoder()
+        if self.n_frames % self.every == 0:
+            # copied as environments may update their observation in place
+            self.pending.put(np.array(frame, dtype=np.uint8, order="C"))
+        self.n_frames += 1
+
+    def close(self) -> None:
+        """Wait for all the frames to be encoded and finalize the video."""
+        self.pending.put(None)
+        self.encoder.join()
+        self._check_encoder()
+
+    def __enter__(self) -> "VideoSink":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+CHUNK_REGEXP = re.compile("^chunk_([0-9]*).npz$")
+# metadata of a chunked run: env_id, seed and whether states are recorded
+RUN_META_FILE = "meta.yaml"
+# chunks of the states regenerated by replaying a run recorded without them
+REPLAY_DIR = "replay"
+
+
+def write_chunk(
+    path: str, index: int, states: Optional[np.array], actions: np.array
+) -> None:
+    """Write a chunk of a human run as a compressed .npz
+
+    Each state is stored as its XOR with the previous state of the chunk:
+    consecutive NES frames are nearly identical so the deltas are mostly zeros
+    and compress well. The first state of the chunk is stored as is, so that
+    every chunk can be decoded on its own.
+
+    Args:
+        path : directory of the run
+        index : index of the chunk in the run
+        states : states of the chunk, None to only store the actions
+        actions : actions of the chunk
+    """
+    arrays = {"actions": np.asarray(actions)}
+    if states is not None:
+        states = np.asarray(states, dtype=np.uint8)
+        arrays["states"] = states.copy()
+        arrays["states"][1:] ^= states[:-1]
+    chunk_path = os.path.join(path, f"chunk_{index:06d}.npz")
+    # write then rename so that a crash never leaves a truncated chunk
+    with open(chunk_path + ".tmp", "wb") as f:
+        np.savez_compressed(f, **arrays)
+    os.replace(chunk_path + ".tmp", chunk_path)
+
+
+def read_chunk(
+    chunk_path: str, with_states: bool = True
+) -> Tuple[np.array, Optional[np.array]]:
+    """Read a chunk written by write_chunk
+
+    Args:
+        chunk_path : path of the chunk
+        with_states : whether to decode the states or only read the actions
+
+    Returns:
+        Actions and States of the chunk, None if it has no states
+    """
+    with np.load(chunk_path) as chunk:
+        actions = chunk["actions"]
+        states = None
+        if with_states and "states" in chunk.files:
+            states = np.bitwise_xor.accumulate(chunk["states"], axis=0)
+    return actions, states
+
+
+def list_chunks(run_path: str) -> List[str]:
+    """List the chunks of a run, in order
+
+    Args:
+        run_path : directory of the run
+
+    Returns:
+        Paths of the chunks
+    """
+    chunks = sorted(
+        (int(CHUNK_REGEXP.search(f).group(1)), f)
+        for f in os.listdir(run_path)
+        if CHUNK_REGEXP.search(f)
     )
-    for state in states:
-        out.write(state)
-    out.release()
+    return [os.path.join(run_path, f) for _, f in chunks]
+
+
+class ChunkedStates:
+    """The states of a chunked run, seen as an array
+
+    Chunks are decoded on access and the last decoded ones are kept in memory,
+    so reading a run sequentially decodes each chunk once.
+    """
+
+    def __init__(self, chunk_paths: List[str], lengths: List[int], cached: int = 4):
+        self.chunk_paths = chunk_paths
+        self.offsets = np.cumsum([0] + lengths)
+        self.cached = cached
+        self.cache = OrderedDict()
+
+    def __len__(self) -> int:
+        return int(self.offsets[-1])
 
+    def __getitem__(self, key: Union[int, slice]) -> np.array:
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                raise IndexError("only contiguous slices of states are supported")
+            if stop <= start:
+                return self._chunk(0)[0:0]
+            first = int(np.searchsorted(self.offsets, start, side="right")) - 1
+            last = int(np.searchsorted(self.offsets, stop - 1, side="right")) - 1
+            parts = []
+            for i in range(first, last + 1):
+                offset = int(self.offsets[i])
+                parts.append(self._chunk(i)[max(start - offset, 0) : stop - offset])
+            return parts[0] if len(parts) == 1 else np.concatenate(parts)
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError(f"index {key} out of range for {len(self)} states")
+        i = int(np.searchsorted(self.offsets, key, side="right")) - 1
+        return self._chunk(i)[key - self.offsets[i]]
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        """Shape of the states of the run"""
+        return (len(self), *self._chunk(0).shape[1:])
+
+    def _chunk(self, i: int) -> np.array:
+        """Decode a chunk, or get it from the cache
+
+        Args:
+            i : index of the chunk
+
+        Returns:
+            The states of the chunk
+        """
+        if i in self.cache:
+            self.cache.move_to_end(i)
+        else:
+            _, self.cache[i] = read_chunk(self.chunk_paths[i])
+            if len(self.cache) > self.cached:
+                self.cache.popitem(last=False)
+        return self.cache[i]
+
+
+class HumanData:
+    """The human runs seen as a single lazy dataset of (state, action) pairs.
+
+    States stay on disk, one array-like per run. A global index is
+    resolved to a (run, offset) pair with the cumulative lengths of the runs.
+    `run_paths` are the directories the runs were loaded from, if any. As
+    FrameStackDataset, it is a map-style dataset for torch's DataLoader without
+    subclassing torch's Dataset, not to import torch with this module.
+    """
+
+    def __init__(
+        self,
+        actions: List[np.array],
+        states: List[np.array],
+        run_paths: Optional[List[str]] = None,
+    ) -> None:
+        for actions_i, states_i in zip(actions, states):
+            n_actions, n_states = actions_i.shape[0], states_i.shape[0]
+            if n_actions != n_states:
+                raise ValueError(f"run of {n_actions} actions and {n_states} states")
+        self.actions = actions
+        self.states = states
+        self.run_paths = run_paths
+        self.offsets = np.cumsum([0] + [a.shape[0] for a in actions])
+
+    def __len__(self) -> int:
+        return int(self.offsets[-1])
+
+    def __getitem__(self, idx: int) -> Tuple[np.array, int]:
+        run, offset = self.locate(idx)
+        return self.states[run][offset], self.actions[run][offset]
+
+    @property
+    def frame_shape(self) -> Tuple[int, ...]:
+        """Shape of a single state"""
+        return self.states[0].shape[1:]
+
+    def locate(self, idx: int) -> Tuple[int, int]:
+        """Find where a state is stored
+
+        Args:
+            idx : global index of the state
+
+        Returns:
+            The run containing the state and the offset of the state in the run
+        """
+        if not 0 <= idx < len(self):
+            raise IndexError(f"index {idx} out of range for {len(self)} states")
+        run = int(np.searchsorted(self.offsets, idx, side="right")) - 1
+        return run, idx - int(self.offsets[run])
+
+
+def run_meta(run_path: str) -> dict:
+    """Load the meta data of a run, see lib.play_human.SaveCallback
+
+    Args:
+        run_path : directory of the run
+
+    Returns:
+        The meta data, empty for the runs recorded without it
+    """
+    meta_path = os.path.join(run_path, RUN_META_FILE)
+    return load_config(meta_path) if os.path.exists(meta_path) else {}
+
+
+def list_human_runs(data_path: str) -> List[str]:
+    """List the human runs with recorded steps, in order
+
+    A session still recording, or killed, before writing its first chunk leaves
+    a run directory without any step: it is skipped with a warning.
+
+    Args:
+        data_path : Path of the directory containing all the human data
+
+    Returns:
+        The directories of the runs
+    """
+    run_paths = []
+    for d in sorted(os.listdir(data_path)):
+        run_path = os.path.join(data_path, d)
+        if list_chunks(run_path) or os.path.exists(
+            os.path.join(run_path, "states.npy")
+        ):
+            run_paths.append(run_path)
+        else:
+            print(f"[WARNING] Run {run_path} has no recorded steps, it is skipped")
+    return run_paths
+
+
+def load_run_actions(run_path: str) -> np.array:
+    """Load the actions of a run, chunked or not, without its states
+
+    Args:
+        run_path : directory of the run
+
+    Returns:
+        The actions of the run
+    """
+    chunk_paths = list_chunks(run_path)
+    if chunk_paths:
+        return np.concatenate(
+            [read_chunk(p, with_states=False)[0] for p in chunk_paths]
+        )
+    import pandas as pd  # pylint: disable=C0415
 
-def load_human_data(data_path: str) -> Tuple[np.array, List[np.array]]:
+    actions_filepath = os.path.join(run_path, "actions.csv")
+    return np.array(pd.read_csv(actions_filepath, header=None)[0])
+
+
+def load_human_actions(data_path: str) -> List[np.array]:
+    """Load the actions of all the human runs, without their states
+
+    Args:
+        data_path : Path of the directory containing all the human data
+
+    Returns:
+        The actions of each run
+    """
+    return [load_run_actions(p) for p in list_human_runs(data_path)]
+
+
+def actions_only_runs(data_path: str) -> List[str]:
+    """List the human runs recorded without their states
+
+    Args:
+        data_path : Path of the directory containing all the human data
+
+    Returns:
+        The directories of the runs
+    """
+    return [
+        p
+        for p in list_human_runs(data_path)
+        if not run_meta(p).get("record_states", True)
+    ]
+
+
+def load_replayed_states(run_path: str, lengths: List[int]) -> ChunkedStates:
+    """Load the states of a run recorded without them, once replayed
+
+    Args:
+        run_path : directory of the run
+        lengths : number of steps of each chunk of the run
+
+    Returns:
+        The states of the run, chunked as its actions
+    """
+    replay_path = os.path.join(run_path, REPLAY_DIR)
+    if not os.path.exists(replay_path):
+        raise FileNotFoundError(
+            f"{run_path} was recorded without its states and not replayed yet, "
+            "see lib.env.load_human_data"
+        )
+    return ChunkedStates(list_chunks(replay_path), lengths)
+
+
+def load_human_data(data_path: str) -> HumanData:
     """Load all human data generated by generate_human_data.py
 
+    The states are memory-mapped (states.npy runs) or decoded chunk by chunk
+    (chunked runs, see write_chunk) so that only the frames actually read are
+    loaded in memory. The runs recorded without their states must have been
+    replayed, see lib.env.load_human_data.
+
     Args:
         data_path : Path of the directory containing all the human data
 
     Returns:
-        Actions and States generated by humans
+        A lazy dataset of the actions and states generated by humans
     """
     actions = []
     states = []
-    for d in os.listdir(data_path):
-        actions_filepath = os.path.join(data_path, d, "actions.csv")
-        actions_i = pd.read_csv(actions_filepath, header=None)
-        print(f"[INFO] File {actions_filepath} contains {actions_i.shape[0]} actions")
-        actions.append(actions_i)
-
-        states_filepath = os.path.join(data_path, d, "states.npy")
-        states_i = np.load(states_filepath)
+    run_paths = list_human_runs(data_path)
+    for run_path in run_paths:
+        chunk_paths = list_chunks(run_path)
+        if chunk_paths:
+            chunk_actions = [read_chunk(p, with_states=False)[0] for p in chunk_paths]
+            actions.append(np.concatenate(chunk_actions))
+            print(f"[INFO] Run {run_path} contains {actions[-1].shape[0]} actions")
+            lengths = [a.shape[0] for a in chunk_actions]
+            if run_meta(run_path).get("record_states", True):
+                states.append(ChunkedStates(chunk_paths, lengths))
+            else:
+                states.append(load_replayed_states(run_path, lengths))
+            continue
+
+        actions.append(load_run_actions(run_path))
+        print(f"[INFO] Run {run_path} contains {actions[-1].shape[0]} actions")
+
+        states_filepath = os.path.join(run_path, "states.npy")
+        states_i = np.load(states_filepath, mmap_mode="r")
         print(
             f"[INFO] File {states_filepath} contains {states_i.shape[0]} states of shape \
                 ({states_i.shape[1]}, {states_i.shape[2]})"
         )
-        states.append(np.load(states_filepath))
+        states.append(states_i)
+
+    data = HumanData(actions, states, run_paths)
+
+    height, width = data.frame_shape[0], data.frame_shape[1]
+    print(f"[INFO] {len(data)} actions collected")
+    print(f"[INFO] {len(data)} states collected of shape ({height}, {width})")
+    return data
+
 
-    actions = pd.concat(actions)
-    states = functools.reduce(lambda a, b: np.concatenate((a, b), axis=0), states)
+class FrameStackDataset:
+    """Stacks of consecutive human frames, each labelled with the action of its
+    last frame.
 
-    print(f"[INFO] {actions.shape[0]} actions collected")
-    print(
-        f"[INFO] {states.shape[0]} states collected of shape ({states.shape[1]}, {states.shape[2]})"
+    Frames are kept once as uint8 in the underlying HumanData, a stack is only
+    assembled (and preprocessed, see preprocess_frame) when requested. Stacks
+    never span two runs. With `augment` > 0, each stack is randomly shifted by
+    up to `augment` pixels, the borders being replicated.
+    """
+
+    def __init__(  # pylint: disable=R0913
+        self,
+        data: HumanData,
+        stacks: int,
+        crop_top: int = 0,
+        resize: int = 0,
+        augment: int = 0,
+    ) -> None:
+        self.data = data
+        self.stacks = stacks
+        self.crop_top = crop_top
+        self.resize = resize
+        self.augment = augment
+        # global index of the last frame of every valid stack
+        self.ends = np.concatenate(
+            [
+                np.arange(start + stacks - 1, stop)
+                for start, stop in zip(data.offsets[:-1], data.offsets[1:])
+            ]
+        )
+
+    def __len__(self) -> int:
+        return self.ends.shape[0]
+
+    def __getitem__(self, idx: int) -> Tuple[torch.Tensor, int]:
+        import torch  # pylint: disable=C0415
+
+        run, offset = self.data.locate(int(self.ends[idx]))
+        frames = self.data.states[run][offset - self.stacks + 1 : offset + 1]
+        if self.crop_top or self.resize:
+            frames = np.stack(
+                [preprocess_frame(f, self.crop_top, self.resize) for f in frames]
+            )
+        height, width = frames.shape[1], frames.shape[2]
+        frames = np.reshape(frames, (1, self.stacks, height, width))
+        if self.augment:
+            pad = self.augment
+            frames = np.pad(frames, ((0, 0), (0, 0), (pad, pad), (pad, pad)), "edge")
+            # torch's RNG is seeded differently in each DataLoader worker
+            dy, dx = torch.randint(0, 2 * pad + 1, (2,)).tolist()
+            frames = frames[:, :, dy : dy + height, dx : dx + width]
+        frames = np.array(frames, order="C")  # copy out of the memory map
+        action = int(self.data.actions[run][offset])
+        return torch.from_numpy(frames), action  # pylint: disable=E1101
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        """Shape of a single stack of frames, as fed to the model"""
+        height, width, _ = preprocessed_shape(
+            self.data.frame_shape, self.crop_top, self.resize
+        )
+        return (1, self.stacks, height, width)
+
+
+def collate_frames(
+    batch: List[Tuple[torch.Tensor, int]]
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Assemble stacks of uint8 frames as a float batch
+
+    Args:
+        batch : the stacks of frames and their actions
+
+    Returns:
+        The batch of frames as float and the batch of actions
+    """
+    import torch  # pylint: disable=C0415
+
+    frames, actions = zip(*batch)
+    frames = torch.stack(frames).float()  # pylint: disable=E1101
+    actions = torch.tensor(actions, dtype=torch.long)  # pylint: disable=E1101
+    return frames, actions
+
+
+CACHE_KEYS = ["stacks", "seed", "test_size", "crop_top", "resize"]
+# key of the human runs a cached dataset was preprocessed from
+CACHE_RUNS_FILE = "runs.key"
+
+
+def runs_key(data: HumanData) -> str:
+    """Hash the human runs of a dataset
+
+    Runs are identified by the name, size and modification time of their files,
+    so a new or re-recorded run changes the key.
+
+    Args:
+        data : the human data, loaded by load_human_data
+
+    Returns:
+        The key of the runs
+    """
+    sha = hashlib.sha256()
+    for run_path in data.run_paths:
+        for f in sorted(os.listdir(run_path)):
+            stat = os.stat(os.path.join(run_path, f))
+            sha.update(f"{run_path}/{f}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+    return sha.hexdigest()[:32]
+
+
+def dataset_key(data: HumanData, config: dict) -> str:
+    """Hash the human runs and the config parameters shaping the dataset
+
+    Args:
+        data : the human data, loaded by load_human_data
+        config : a config file
+
+    Returns:
+        The key of the dataset
+    """
+    sha = hashlib.sha256(runs_key(data).encode())
+    sha.update(repr([(k, config.get(k)) for k in CACHE_KEYS]).encode())
+    return sha.hexdigest()[:32]
+
+
+def evict_stale_caches(cache_path: str, key: str) -> None:
+    """Remove the cached datasets preprocessed from other human runs
+
+    Each new or re-recorded run makes a new copy of the dataset, see
+    dataset_key: the copies of the previous runs are never read again. The
+    datasets of the same runs with other config parameters, e.g. those of the
+    trials of a sweep, and the caches being written are kept.
+
+    Args:
+        cache_path : directory of the cached datasets
+        key : key of the current runs, see runs_key
+    """
+    for d in os.listdir(cache_path):
+        cache_dir = os.path.join(cache_path, d)
+        if ".tmp" in d or not os.path.isdir(cache_dir):
+            continue
+        key_path = os.path.join(cache_dir, CACHE_RUNS_FILE)
+        if os.path.exists(key_path):
+            with open(key_path, encoding="utf-8") as f:
+                if f.read() == key:
+                    continue
+        print(f"[INFO] Removing the stale cached dataset {cache_dir}")
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+def cache_dataset(  # pylint: disable=R0914
+    data: HumanData, config: dict, cache_dir: str
+) -> None:
+    """Write the preprocessed frames, actions and train/test split of a dataset
+
+    Frames are preprocessed run by run and written straight to a memory-mapped
+    uint8 .npy, so the dataset is never held in memory. The cache is written to
+    a temporary directory renamed at the end, so it is either complete or absent.
+
+    Args:
+        data : the human data
+        config : a config file
+        cache_dir : directory of the cache
+    """
+    from sklearn.model_selection import train_test_split  # pylint: disable=C0415
+
+    crop_top = config.get("crop_top", 0)
+    resize = config.get("resize", 0)
+    tmp_dir = f"{cache_dir}.tmp{os.getpid()}"
+    os.makedirs(tmp_dir)
+
+    shape = preprocessed_shape(data.frame_shape, crop_top, resize)
+    states = np.lib.format.open_memmap(
+        os.path.join(tmp_dir, "states.npy"), "w+", np.uint8, (len(data), *shape)
     )
+    for run, states_i in enumerate(data.states):
+        start = int(data.offsets[run])
+        for i, frame in enumerate(states_i):
+            states[start + i] = preprocess_frame(frame, crop_top, resize)
+    states.flush()
+    del states
 
-    actions = np.array(actions[0])
-    return actions, states
+    np.save(os.path.join(tmp_dir, "actions.npy"), np.concatenate(data.actions))
+    np.save(os.path.join(tmp_dir, "offsets.npy"), data.offsets)
+    n_stacks = len(FrameStackDataset(data, config["stacks"]))
+    train_idx, test_idx = train_test_split(
+        np.arange(n_stacks), test_size=config["test_size"], random_state=config["seed"]
+    )
+    np.save(os.path.join(tmp_dir, "train_idx.npy"), train_idx)
+    np.save(os.path.join(tmp_dir, "test_idx.npy"), test_idx)
+    with open(os.path.join(tmp_dir, CACHE_RUNS_FILE), "w", encoding="utf-8") as f:
+        f.write(runs_key(data))
+    os.rename(tmp_dir, cache_dir)
+
+
+def load_cached_dataset(cache_dir: str) -> Tuple[HumanData, np.array, np.array]:
+    """Load a dataset written by cache_dataset
+
+    Args:
+        cache_dir : directory of the cache
+
+    Returns:
+        The preprocessed human data (memory-mapped) and the train/test split
+    """
+    states = np.load(os.path.join(cache_dir, "states.npy"), mmap_mode="r")
+    actions = np.load(os.path.join(cache_dir, "actions.npy"))
+    offsets = np.load(os.path.join(cache_dir, "offsets.npy"))
+    runs = list(zip(offsets[:-1], offsets[1:]))
+    data = HumanData(
+        [actions[start:stop] for start, stop in runs],
+        [states[start:stop] for start, stop in runs],
+    )
+    train_idx = np.load(os.path.join(cache_dir, "train_idx.npy"))
+    test_idx = np.load(os.path.join(cache_dir, "test_idx.npy"))
+    return data, train_idx, test_idx
 
 
 def transform_data(  # pylint: disable=R0914
-    actions: np.array, states: List[np.array], config: dict
+    data: HumanData, config: dict
 ) -> Tuple[torch.utils.data.DataLoader, torch.utils.data.DataLoader]:
     """Transform data for model training
 
+    If `cache_path` is set, the preprocessed frames and the train/test split are
+    cached there on the first run and memory-mapped on the next ones, see
+    cache_dataset, and the datasets of previous runs are removed, see
+    evict_stale_caches. It is required for chunked runs: the samples of the split
+    are read in random order, and each one would decode a whole chunk.
+
     Args:
-        actions : a list of input command
-        states : a list of frames
+        data : the human data
         config : a config file
 
     Returns:
         Train and test data ready to feed a model
     """
+    import torch  # pylint: disable=C0415
+    from sklearn.model_selection import train_test_split  # pylint: disable=C0415
+
     stacks = config["stacks"]
     seed = config["seed"]
     batch_size = config["batch_size"]
     test_size = config["test_size"]
+    crop_top = config.get("crop_top", 0)
+    resize = config.get("resize", 0)
+    num_workers = config.get("num_workers", 0)
+    cache_path = config.get("cache_path")
+    if not cache_path and any(isinstance(s, ChunkedStates) for s in data.states):
+        raise ValueError("cache_path must be set to train on chunked runs")
 
-    X = states.reshape(
-        states.shape[0], states.shape[1], states.shape[2]
-    )  # drop last dimension for vectorizing
-
-    # vectorize the frame by stacks
-    u = np.lib.stride_tricks.sliding_window_view(np.arange(X.shape[0]), stacks)
-    u = u.flatten()
-    X = X[u].reshape(-1, X.shape[1], X.shape[2], stacks)
-    X = X.reshape(
-        X.shape[0], X.shape[1], X.shape[2], X.shape[3], 1
-    )  # add one channel because frames are b&w
-
-    # truncate the start (time to get enough frames to associate an action to a stack of frame)
-    actions = actions[stacks - 1 :]
-
-    X_train, X_test, target_train, target_test = train_test_split(
-        X, actions, test_size=test_size, random_state=seed
-    )
-
-    train_x = (
-        torch.from_numpy(X_train)  # pylint: disable=E1101
-        .permute(0, 4, 3, 1, 2)
-        .float()
-    )
-    train_y = torch.from_numpy(target_train).long()  # pylint: disable=E1101
-    test_x = (
-        torch.from_numpy(X_test).permute(0, 4, 3, 1, 2).float()  # pylint: disable=E1101
+    if cache_path and data.run_paths:
+        cache_dir = os.path.join(cache_path, dataset_key(data, config))
+        if not os.path.exists(cache_dir):
+            print(f"[INFO] Caching the preprocessed dataset in {cache_dir}")
+            os.makedirs(cache_path, exist_ok=True)
+            cache_dataset(data, config, cache_dir)
+            evict_stale_caches(cache_path, runs_key(data))
+        data, train_idx, test_idx = load_cached_dataset(cache_dir)
+        crop_top, resize = 0, 0  # the cached frames are already preprocessed
+        dataset = FrameStackDataset(data, stacks)
+    else:
+        dataset = FrameStackDataset(data, stacks, crop_top, resize)
+        train_idx, test_idx = train_test_split(
+            np.arange(len(dataset)), test_size=test_size, random_state=seed
+        )
+    train_dataset = FrameStackDataset(
+        data, stacks, crop_top, resize, config.get("augment", 0)
     )
-    test_y = torch.from_numpy(target_test).long()  # pylint: disable=E1101
+    train = torch.utils.data.Subset(train_dataset, train_idx)
+    test = torch.utils.data.Subset(dataset, test_idx)
 
-    train = torch.utils.data.TensorDataset(train_x, train_y)
-    test = torch.utils.data.TensorDataset(test_x, test_y)
+    # stacks are assembled, preprocessed and cast to float in the workers
+    loader_kwargs = {
+        "batch_size": batch_size,
+        "collate_fn": collate_frames,
+        "num_workers": num_workers,
+        "pin_memory": config.get("pin_memory", False),
+    }
+    if num_workers:
+        loader_kwargs["prefetch_factor"] = config.get("prefetch_factor", 2)
+        loader_kwargs["persistent_workers"] = config.get("persistent_workers", False)
 
     train_loader = torch.utils.data.DataLoader(
-        train, batch_size=batch_size, shuffle=False
-    )
-    test_loader = torch.utils.data.DataLoader(
-        test, batch_size=batch_size, shuffle=False
+        train,
+        shuffle=config.get("shuffle", False),
+        generator=torch.Generator().manual_seed(seed),
+        **loader_kwargs,
     )
+    test_loader = torch.utils.data.DataLoader(test, shuffle=False, **loader_kwargs)
     return train_loader, test_loader
 
 
+RL_MODEL_REGEXP = re.compile("^model_([0-9]*).zip$")
+SWEEP_RL_FILE = "sweep_rl.csv"
+
+
+def list_rl_models(model_dir: str) -> Dict[int, str]:
+    """List the RL models saved in a directory
+
+    Args:
+        model_dir : the directory to search in
+
+    Returns:
+        The file of each model, by step
+    """
+    return {
+        int(RL_MODEL_REGEXP.search(x).group(1)): x
+        for x in os.listdir(model_dir)
+        if RL_MODEL_REGEXP.search(x)
+    }
+
+
 def get_max_step_rl_model(model_dir: str) -> str:
     """Get the last RL model path
 
@@ -242,17 +1006,32 @@ def get_max_step_rl_model(model_dir: str) -> str:
     Returns:
         The max step available for the model
     """
-    regexp = re.compile("^model_([0-9]*).zip$")
-    return max(
-        int(regexp.search(x).group(1))
-        for x in os.listdir(model_dir)
-        if regexp.search(x)
-    )
+    return max(list_rl_models(model_dir))
+
+
+def file_hash(path: str) -> str:
+    """Hash the content of a file
+
+    Args:
+        path : path of the file
+
+    Returns:
+        The sha256 hex digest of the file
+    """
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
 
 
 def generate_x_pos_fig(path: str, out_path: str) -> None:
     """Generate the figure of the distance travelled by Mario
 
+    If the directory holds the table written by sweep_rl.py, the figure shows the
+    mean and max x_pos reached by each checkpoint. Otherwise it shows the x_pos
+    along the runs exported by run_rl.py.
+
     Example:
         generate_x_pos_fig("data/models/50bkOHBpXFl2RnGJVImI1MzvI9iXvF26", 'img/x_pos.png')
 
@@ -260,10 +1039,24 @@ def generate_x_pos_fig(path: str, out_path: str) -> None:
         path : path of the x_pos files
         out_path : path of the figure
     """
-    regexp = re.compile("x_pos_rl_([0-9]*).csv")
+    import pandas as pd  # pylint: disable=C0415
+    from matplotlib import pyplot as plt  # pylint: disable=C0415
+
+    sweep_path = os.path.join(path, SWEEP_RL_FILE)
+    if os.path.exists(sweep_path):
+        sweep = pd.read_csv(sweep_path).sort_values("step")
+        plt.plot(sweep["step"], sweep["mean_x_pos"], label="mean x_pos")
+        plt.plot(sweep["step"], sweep["max_x_pos"], label="max x_pos")
+        plt.xlabel("frames")
+        plt.legend()
+        plt.savefig(out_path)
+        plt.close()
+        return
+
+    regexp = re.compile("^x_pos_rl_([0-9]*).csv$")
 
     x_pos = {}
-    for file in [f for f in os.listdir(path) if ".csv" in f]:
+    for file in [f for f in os.listdir(path) if regexp.search(f)]:
         x_pos_i = pd.read_csv(os.path.join(path, file), header=None)
         x_pos[f"{regexp.search(file).group(1)} frames"] = np.array(x_pos_i[0])
 
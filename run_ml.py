@@ -1,38 +1,171 @@
-""" Let a model play the game """
+""" Let a model play the game
+
+torch is imported once a model is loaded, see lib.utils.
+"""
 
 import argparse
 import os
+from typing import List
 
 import gym_super_mario_bros.actions
-import torch
 
 import lib.env
-import lib.model_ml
+import lib.profiling
+import lib.serving
 import lib.utils
 
+# int8 TorchScript policy written by export_model.py
+EXPORTED_ML_FILE = "model_cnn.int8.pt"
+
+
+def load_ml_model(directory: str, config: dict, exported: bool = False):
+    """Load a ML model, of the class given by the config it was trained with
+
+    Args:
+        directory : directory containing the model
+        config : config parameters the model was trained with
+        exported : load the policy exported by export_model.py instead
+
+    Returns:
+        The model
+    """
+    # pylint: disable=C0415
+    if exported:
+        from lib import export
+
+        return export.load_exported(os.path.join(directory, EXPORTED_ML_FILE))
+    from lib import model_ml
+
+    height, width, stacks = lib.env.observation_shape(config)
+    return model_ml.load_model(
+        os.path.join(directory, "model_cnn.pyt"),
+        config,
+        len(gym_super_mario_bros.actions.SIMPLE_MOVEMENT),
+        (stacks, height, width),
+    )
+
 
-def run_ml(directory: str):
+def run_ml(  # pylint: disable=R0913
+    directory: str,
+    render: bool = False,
+    every: int = 1,
+    scale: float = 1.0,
+    profile: str = "",
+    exported: bool = False,
+):
     """Run a ML model on an env and export the states as a video
 
+    The video is encoded while the model plays, keeping one frame every `every`
+    downscaled by `scale`. The run is profiled to the `profile` sinks, see
+    lib.profiling.create_profiler. With `exported`, the policy exported by
+    export_model.py plays instead of the model.
+
     Example:
         python run_ml.py -d="data/models/b6YCgIyFr1sO5iWtTSKkdvEH4Smm8Lgr"
     """
     config = lib.utils.load_config(os.path.join(directory, "config.yaml"))
 
-    env = lib.env.create_stacked_env(config["stacks"])
-    model = lib.model_ml.CNNModel(len(gym_super_mario_bros.actions.SIMPLE_MOVEMENT), 1)
-    model.load_state_dict(torch.load(os.path.join(directory, "model_cnn.pyt")))
+    env = lib.env.create_stacked_env(
+        config["stacks"], **lib.env.preprocessing_from_config(config)
+    )
+    model = load_ml_model(directory, config, exported)
+
+    video_path = os.path.join(directory, "run_ml.mp4")
+    profiler = lib.profiling.create_profiler(profile, directory, "run_ml")
+    # the env observes one frame every frame_skip frames of the 60 fps NES
+    fps = 60 / config.get("frame_skip", 1)
+    with profiler, lib.utils.VideoSink(video_path, fps, every, scale) as sink:
+        lib.env.run(env, model, render, sink, profiler)
+
+
+def evaluate_ml(  # pylint: disable=R0913
+    directory: str,
+    n_episodes: int = 10,
+    stages: List[str] = None,
+    n_envs: int = 1,
+    max_steps: int = None,
+    profile: str = "",
+    n_clients: int = 0,
+    exported: bool = False,
+):
+    """Evaluate a ML model over several episodes and export the results, see
+    run_ml for `profile` and `exported`
 
-    states, _ = lib.env.run(env, model)
-    states = states[:, 0, :, :, 3]
-    lib.utils.states_to_mp4(states, os.path.join(directory, "run_ml.mp4"))
+    With `n_clients` processes, each stepping `n_envs` emulators, the model is
+    loaded once by a policy server batching their predictions, see
+    lib.serving.evaluate_served. The profiler is then unused.
+
+    Example:
+        python run_ml.py -d="data/models/b6YCgIyFr1sO5iWtTSKkdvEH4Smm8Lgr" -n=32 -w=8
+    """
+    config = lib.utils.load_config(os.path.join(directory, "config.yaml"))
+    if n_clients:
+        episodes, stats = lib.serving.evaluate_served(
+            os.path.join(directory, EXPORTED_ML_FILE if exported else "model_cnn.pyt"),
+            config,
+            n_episodes,
+            n_clients,
+            stages,
+            n_envs,
+            max_steps,
+        )
+    else:
+        model = load_ml_model(directory, config, exported)
+        profiler = lib.profiling.create_profiler(profile, directory, "eval_ml")
+        with profiler:
+            episodes, stats = lib.env.evaluate(
+                model,
+                config,
+                n_episodes,
+                stages=stages,
+                n_envs=n_envs,
+                max_steps=max_steps,
+                profiler=profiler,
+            )
+    print(f"[INFO] {stats}")
+    episodes.to_csv(os.path.join(directory, "eval_ml.csv"), index=False)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-d", "--directory", help="Directory containing the ML model")
+    parser.add_argument("-r", "--render", action="store_true", help="Display the run")
+    parser.add_argument("-n", "--episodes", type=int, help="Episodes to evaluate")
+    parser.add_argument("-s", "--stages", nargs="+", help="Stages, e.g. 1-1")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Emulators")
+    parser.add_argument("-m", "--max-steps", type=int, help="Steps per episode")
+    parser.add_argument("-e", "--every", type=int, default=1, help="Video decimation")
+    parser.add_argument("--scale", type=float, default=1.0, help="Video scale")
+    parser.add_argument(
+        "-p", "--profile", default="", help="Profiler sinks, e.g. stdout,csv"
+    )
+    parser.add_argument(
+        "-c", "--clients", type=int, default=0, help="Processes sharing a server"
+    )
+    parser.add_argument(
+        "-x", "--exported", action="store_true", help="Play the exported policy"
+    )
     args = parser.parse_args()
 
     if args.directory is None:
         raise TypeError("missing 1 positional parameter (-d or --directory)")
-    run_ml(args.directory)
+    if args.episodes is None:
+        run_ml(
+            args.directory,
+            args.render,
+            args.every,
+            args.scale,
+            args.profile,
+            args.exported,
+        )
+    else:
+        evaluate_ml(
+            args.directory,
+            args.episodes,
+            args.stages,
+            args.workers,
+            args.max_steps,
+            args.profile,
+            args.clients,
+            args.exported,
+        )
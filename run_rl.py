@@ -1,37 +1,99 @@
-""" Let a model play the game """
+""" Let a model play the game
+
+torch, stable_baselines3 and pandas are imported once a model is loaded, see
+lib.utils.
+"""
 
 import argparse
 import os
-import re
-
-import pandas as pd
-from stable_baselines3 import PPO
+from typing import List, Tuple
 
 import lib.env
+import lib.profiling
+import lib.serving
 import lib.utils
 
 
-def run_rl(directory: str, file: str = None):
-    """Run a RL model on an env and export the states as a video
+def rl_model_path(
+    directory: str, file: str = None, exported: bool = False
+) -> Tuple[str, int]:
+    """Get the path of a RL model
 
-    Example:
-        python run_rl.py -d="data/models/50bkOHBpXFl2RnGJVImI1MzvI9iXvF26" -f="model_5000.zip"
-    """
-    config = lib.utils.load_config(os.path.join(directory, "config.yaml"))
+    Args:
+        directory : directory containing the models
+        file : file of the model, the last one if None
+        exported : get the path of the policy exported by export_model.py
 
-    env = lib.env.create_stacked_env(config["stacks"])
+    Returns:
+        The path of the model and its step
+    """
     if file is None:
         step_model = lib.utils.get_max_step_rl_model(directory)
         model_path = os.path.join(directory, f"model_{step_model}.zip")
     else:
+        step_model = int(lib.utils.RL_MODEL_REGEXP.search(file).group(1))
         model_path = os.path.join(directory, file)
-        regexp = re.compile("^model_([0-9]*).zip$")
-        step_model = int(regexp.search(file).group(1))
-    model = PPO.load(model_path)
+    if exported:
+        model_path = os.path.splitext(model_path)[0] + ".int8.pt"
+    return model_path, step_model
+
+
+def load_rl_model(directory: str, file: str = None, exported: bool = False):
+    """Load a RL model
 
-    states, x_pos = lib.env.run(env, model)
-    states = states[:, 0, :, :, 3]
-    lib.utils.states_to_mp4(states, os.path.join(directory, f"run_rl_{step_model}.mp4"))
+    Args:
+        directory : directory containing the models
+        file : file of the model, the last one if None
+        exported : load the policy exported by export_model.py instead
+
+    Returns:
+        The model and its step
+    """
+    # pylint: disable=C0415
+    model_path, step_model = rl_model_path(directory, file, exported)
+    if exported:
+        from lib import export
+
+        return export.load_exported(model_path), step_model
+    from stable_baselines3 import PPO
+
+    return PPO.load(model_path), step_model
+
+
+def run_rl(  # pylint: disable=R0913,R0914
+    directory: str,
+    file: str = None,
+    render: bool = False,
+    every: int = 1,
+    scale: float = 1.0,
+    profile: str = "",
+    exported: bool = False,
+):
+    """Run a RL model on an env and export the states as a video
+
+    The video is encoded while the model plays, keeping one frame every `every`
+    downscaled by `scale`. The run is profiled to the `profile` sinks, see
+    lib.profiling.create_profiler. With `exported`, the policy exported by
+    export_model.py plays instead of the model, deterministically.
+
+    Example:
+        python run_rl.py -d="data/models/50bkOHBpXFl2RnGJVImI1MzvI9iXvF26" -f="model_5000.zip"
+    """
+    config = lib.utils.load_config(os.path.join(directory, "config.yaml"))
+
+    env = lib.env.create_stacked_env(
+        config["stacks"], **lib.env.preprocessing_from_config(config)
+    )
+    model, step_model = load_rl_model(directory, file, exported)
+
+    video_path = os.path.join(directory, f"run_rl_{step_model}.mp4")
+    profiler = lib.profiling.create_profiler(profile, directory, f"run_rl_{step_model}")
+    # the env observes one frame every frame_skip frames of the 60 fps NES
+    fps = 60 / config.get("frame_skip", 1)
+    with profiler, lib.utils.VideoSink(video_path, fps, every, scale) as sink:
+        x_pos = lib.env.run(env, model, render, sink, profiler)
+
+    import pandas as pd  # pylint: disable=C0415
 
     pd.DataFrame(x_pos).to_csv(
         os.path.join(directory, f"x_pos_rl_{step_model}.csv"),
@@ -40,12 +102,95 @@ def run_rl(directory: str, file: str = None):
     )
 
 
+def evaluate_rl(  # pylint: disable=R0913,R0914
+    directory: str,
+    file: str = None,
+    n_episodes: int = 10,
+    stages: List[str] = None,
+    n_envs: int = 1,
+    max_steps: int = None,
+    profile: str = "",
+    n_clients: int = 0,
+    exported: bool = False,
+):
+    """Evaluate a RL model over several episodes and export the results, see
+    run_rl for `profile` and `exported`
+
+    With `n_clients` processes, each stepping `n_envs` emulators, the model is
+    loaded once by a policy server batching their predictions, see
+    lib.serving.evaluate_served. The profiler is then unused.
+
+    Example:
+        python run_rl.py -d="data/models/50bkOHBpXFl2RnGJVImI1MzvI9iXvF26" -n=32 -w=8 -s 1-1 1-2
+    """
+    config = lib.utils.load_config(os.path.join(directory, "config.yaml"))
+    if n_clients:
+        model_path, step_model = rl_model_path(directory, file, exported)
+        episodes, stats = lib.serving.evaluate_served(
+            model_path, config, n_episodes, n_clients, stages, n_envs, max_steps
+        )
+    else:
+        model, step_model = load_rl_model(directory, file, exported)
+        profiler = lib.profiling.create_profiler(
+            profile, directory, f"eval_rl_{step_model}"
+        )
+        with profiler:
+            episodes, stats = lib.env.evaluate(
+                model,
+                config,
+                n_episodes,
+                stages=stages,
+                n_envs=n_envs,
+                max_steps=max_steps,
+                profiler=profiler,
+            )
+    print(f"[INFO] {stats}")
+    episodes.to_csv(os.path.join(directory, f"eval_rl_{step_model}.csv"), index=False)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-d", "--directory", help="Directory containing the models")
     parser.add_argument("-f", "--file", help="File containing the model")
+    parser.add_argument("-r", "--render", action="store_true", help="Display the run")
+    parser.add_argument("-n", "--episodes", type=int, help="Episodes to evaluate")
+    parser.add_argument("-s", "--stages", nargs="+", help="Stages, e.g. 1-1")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Emulators")
+    parser.add_argument("-m", "--max-steps", type=int, help="Steps per episode")
+    parser.add_argument("-e", "--every", type=int, default=1, help="Video decimation")
+    parser.add_argument("--scale", type=float, default=1.0, help="Video scale")
+    parser.add_argument(
+        "-p", "--profile", default="", help="Profiler sinks, e.g. stdout,csv"
+    )
+    parser.add_argument(
+        "-c", "--clients", type=int, default=0, help="Processes sharing a server"
+    )
+    parser.add_argument(
+        "-x", "--exported", action="store_true", help="Play the exported policy"
+    )
     args = parser.parse_args()
 
     if args.directory is None:
         raise TypeError("missing 1 positional parameter (-d or --directory)")
-    run_rl(args.directory, args.file)
+    if args.episodes is None:
+        run_rl(
+            args.directory,
+            args.file,
+            args.render,
+            args.every,
+            args.scale,
+            args.profile,
+            args.exported,
+        )
+    else:
+        evaluate_rl(
+            args.directory,
+            args.file,
+            args.episodes,
+            args.stages,
+            args.workers,
+            args.max_steps,
+            args.profile,
+            args.clients,
+            args.exported,
+        )
@@ -0,0 +1,287 @@
+""" Search the hyperparameters of a ML or RL model """
+
+import argparse
+import itertools
+import multiprocessing
+import os
+import random
+import string
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+import torch
+import yaml
+
+import lib.env
+import lib.model_ml
+import lib.model_rl
+import lib.utils
+import train_ml
+
+# metric ranking the trials of each kind of model, higher is better
+METRICS = {"ml": "accuracy", "rl": "mean_x_pos"}
+
+
+class MedianStopping:
+    """Stop a trial whose best metric is below the median of the other trials.
+
+    Every report of a trial is compared to the best metrics the other trials
+    had reached at the same step, once at least `min_trials` of them reported.
+    The reports are shared between the trial processes through a Manager dict.
+    """
+
+    def __init__(self, reports: Dict[int, list], min_trials: int = 3) -> None:
+        """
+        Args:
+            reports : (step, metric) reports of each trial, a Manager dict
+            min_trials : number of other trials to compare to before stopping
+        """
+        self.reports = reports
+        self.min_trials = min_trials
+
+    def __call__(self, trial: int, step: int, metric: float) -> bool:
+        """Report a metric of a trial and tell whether to stop it.
+
+        Args:
+            trial : index of the trial
+            step : its step, e.g. the samples seen or the timesteps
+            metric : its metric at this step
+
+        Returns:
+            Whether to stop the trial
+        """
+        reports = self.reports.get(trial, []) + [(step, float(metric))]
+        self.reports[trial] = reports
+        best = max(m for _, m in reports)
+        others = [
+            max(m for s, m in r if s <= step)
+            for t, r in self.reports.items()
+            if t != trial and any(s <= step for s, _ in r)
+        ]
+        return len(others) >= self.min_trials and best < np.median(others)
+
+
+class TrialStopping:
+    """The early stopping rule of a trial, see MedianStopping"""
+
+    def __init__(self, stopping: MedianStopping, trial: int) -> None:
+        self.stopping = stopping
+        self.trial = trial
+
+    def __call__(self, step: int, metric: float) -> bool:
+        """Report a metric of the trial, see MedianStopping.__call__"""
+        return self.stopping(self.trial, step, metric)
+
+
+def load_spec(path: str) -> dict:
+    """Load a sweep spec from a yaml file
+
+    Args:
+        path : path of the yaml file
+
+    Returns:
+        The spec, with the values of the swept parameters as lists of strings
+    """
+    with open(path, encoding="utf-8") as f:
+        spec = yaml.load(f, Loader=yaml.BaseLoader)
+    for key in ["n_trials", "seed", "min_trials", "threads", "eval_episodes"]:
+        if key in spec:
+            spec[key] = int(spec[key])
+    spec["early_stopping"] = str(spec.get("early_stopping", "false")) == "true"
+    return spec
+
+
+def trial_params(spec: dict) -> List[dict]:
+    """List the parameters of the trials of a grid or random search
+
+    Args:
+        spec : the sweep spec, see load_spec
+
+    Returns:
+        The swept parameters of each trial, cast as in a config
+    """
+    keys = list(spec["params"])
+    grid = [
+        lib.utils.cast_config(dict(zip(keys, values)))
+        for values in itertools.product(*(spec["params"][k] for k in keys))
+    ]
+    if spec.get("search", "grid") == "random":
+        rng = random.Random(spec.get("seed", 0))
+        grid = rng.sample(grid, min(spec["n_trials"], len(grid)))
+    return grid
+
+
+def trial_cores(kind: str, config: dict) -> int:
+    """Get the number of cores a trial keeps busy
+
+    Args:
+        kind : "ml" or "rl"
+        config : config parameters of the trial
+
+    Returns:
+        The number of cores
+    """
+    threads = max(config.get("num_threads", 1), 1)
+    if kind == "ml":
+        return threads + config.get("num_workers", 0)
+    if config.get("vec_env", "dummy") == "subproc":
+        return threads + config.get("n_envs", 1)
+    return threads
+
+
+def ml_trial(config: dict, should_stop: TrialStopping) -> dict:
+    """Train a ML model, in a worker process
+
+    Args:
+        config : config parameters of the trial
+        should_stop : early stopping rule
+
+    Returns:
+        The accuracy of the model and how long it trained
+    """
+    data = lib.env.load_human_data(config["data_path"])
+    train_loader, test_loader = lib.utils.transform_data(data, config)
+    model = train_ml.create_model(config, data)
+    model, metrics = lib.model_ml.learn(
+        model, train_loader, test_loader, config, should_stop=should_stop
+    )
+    os.makedirs(config["save_path"])
+    lib.utils.dump_config(config, os.path.join(config["save_path"], "config.yaml"))
+    model.save(os.path.join(config["save_path"], "model_cnn.pyt"))
+    metrics.to_csv(os.path.join(config["save_path"], "metrics.csv"), index=False)
+    return {
+        "accuracy": metrics["accuracy"].iloc[-1],
+        "iterations": metrics["iteration"].iloc[-1],
+    }
+
+
+def rl_trial(config: dict, should_stop: TrialStopping) -> dict:
+    """Train a RL model then evaluate it, in a worker process
+
+    Args:
+        config : config parameters of the trial
+        should_stop : early stopping rule
+
+    Returns:
+        The evaluation statistics of the model and how long it trained
+    """
+    torch.set_num_threads(max(config.get("num_threads", 1), 1))
+    env = lib.env.create_training_env(config)
+    model = lib.model_rl.learn(config, env, should_stop)
+    env.close()
+    _, stats = lib.env.evaluate(
+        model,
+        config,
+        config["eval_episodes"],
+        n_envs=1,
+        vec_env="dummy",
+    )
+    return {**stats, "timesteps": model.num_timesteps}
+
+
+def run_trial(
+    kind: str, trial: int, config: dict, should_stop: TrialStopping
+) -> Tuple[int, dict]:
+    """Run a trial, in a worker process, see ml_trial and rl_trial"""
+    torch.manual_seed(config["seed"])
+    start = time.perf_counter()
+    result = (ml_trial if kind == "ml" else rl_trial)(config, should_stop)
+    return trial, {**result, "wall_time": time.perf_counter() - start}
+
+
+def prepare_datasets(configs: List[dict]) -> None:
+    """Cache the preprocessed datasets of the ML trials before they start
+
+    The trials then memory-map the same files, their pages being shared
+    through the page cache instead of each trial preprocessing the human data.
+
+    Args:
+        configs : config parameters of the trials
+    """
+    configs = [c for c in configs if c.get("cache_path")]
+    if configs:
+        data = lib.env.load_human_data(configs[0]["data_path"])
+        for config in configs:
+            lib.utils.transform_data(data, config)
+
+
+def sweep(spec_path: str, processes: int = None):  # pylint: disable=R0914
+    """Train a model per point of a grid or random search, in parallel
+
+    The trials run in a process pool sized to the cores available and the cores
+    each trial keeps busy. With early stopping, a trial is stopped when its
+    metric is below the median of the others', see MedianStopping. The trials
+    ranked by metric are written to results.csv in the sweep directory.
+
+    Example:
+        python sweep.py -s sweep_ml.yaml
+    """
+    spec = load_spec(spec_path)
+    kind = spec["kind"]
+    base = lib.utils.load_config(spec["config"])
+    params = trial_params(spec)
+
+    dir_hash = "".join(random.choices(string.ascii_letters + string.digits, k=32))
+    sweep_path = os.path.join(spec.get("save_path", "./data/sweeps/"), dir_hash)
+    os.makedirs(sweep_path, exist_ok=False)
+    lib.utils.dump_config(spec, os.path.join(sweep_path, "sweep.yaml"))
+
+    configs = [
+        {
+            **base,
+            "num_threads": spec.get("threads", 1),
+            "eval_episodes": spec.get("eval_episodes", 5),
+            **p,
+            "save_path": os.path.join(sweep_path, f"trial_{i}"),
+        }
+        for i, p in enumerate(params)
+    ]
+    if kind == "ml":
+        prepare_datasets(configs)
+
+    cores = max(trial_cores(kind, c) for c in configs)
+    if processes is None:
+        processes = max(os.cpu_count() // cores, 1)
+    print(f"[INFO] {len(configs)} trials on {processes} processes")
+
+    metric = METRICS[kind]
+    results = []
+    context = multiprocessing.get_context("forkserver")
+    with context.Manager() as manager:
+        stopping = MedianStopping(manager.dict(), spec.get("min_trials", 3))
+        # not a Pool, whose daemonic workers cannot start DataLoader workers
+        # nor emulator processes
+        with ProcessPoolExecutor(processes, context) as pool:
+            futures = [
+                pool.submit(
+                    run_trial,
+                    kind,
+                    i,
+                    config,
+                    TrialStopping(stopping, i) if spec["early_stopping"] else None,
+                )
+                for i, config in enumerate(configs)
+            ]
+            for future in as_completed(futures):
+                trial, result = future.result()
+                print(f"[INFO] Trial {trial} {params[trial]} {result}")
+                results.append({"trial": trial, **params[trial], **result})
+                # rewrite the table after each trial to keep results on a crash
+                pd.DataFrame(results).sort_values(metric, ascending=False).to_csv(
+                    os.path.join(sweep_path, "results.csv"), index=False
+                )
+    print(pd.DataFrame(results).sort_values(metric, ascending=False))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--spec", help="Sweep spec, e.g. sweep_ml.yaml")
+    parser.add_argument("-p", "--processes", type=int, help="Worker processes")
+    args = parser.parse_args()
+
+    if args.spec is None:
+        raise TypeError("missing 1 positional parameter (-s or --spec)")
+    sweep(args.spec, args.processes)
@@ -0,0 +1,102 @@
+""" Evaluate the checkpoints of a RL model """
+
+import argparse
+import multiprocessing
+import os
+from typing import List, Tuple
+
+import pandas as pd
+import torch
+from stable_baselines3 import PPO
+
+import lib.env
+import lib.utils
+
+
+def evaluate_checkpoint(args: Tuple[str, str, str, dict, int, List[str], int]) -> dict:
+    """Evaluate a checkpoint, in a worker process
+
+    Args:
+        args : directory, file of the checkpoint, its hash, config, number of
+            episodes, stages and max steps per episode
+
+    Returns:
+        The statistics of the checkpoint
+    """
+    directory, file, sha256, config, n_episodes, stages, max_steps = args
+    # the checkpoints are evaluated in parallel, one core each
+    torch.set_num_threads(1)
+    model = PPO.load(os.path.join(directory, file))
+    # pool workers are daemonic and cannot start emulator processes
+    _, stats = lib.env.evaluate(
+        model,
+        config,
+        n_episodes,
+        stages=stages,
+        n_envs=1,
+        vec_env="dummy",
+        max_steps=max_steps,
+    )
+    step = int(lib.utils.RL_MODEL_REGEXP.search(file).group(1))
+    return {"step": step, "file": file, "sha256": sha256, **stats}
+
+
+def sweep_rl(  # pylint: disable=R0913,R0914
+    directory: str,
+    every: int = 1,
+    n_episodes: int = 10,
+    stages: List[str] = None,
+    processes: int = None,
+    max_steps: int = None,
+):
+    """Evaluate every Nth checkpoint of a RL model, in parallel
+
+    Results are appended to sweep_rl.csv in the model directory. A checkpoint
+    whose hash is already in the table is not evaluated again, so re-running the
+    sweep only evaluates the new checkpoints.
+
+    Example:
+        python sweep_rl.py -d="data/models/50bkOHBpXFl2RnGJVImI1MzvI9iXvF26" -e=10 -p=16
+    """
+    config = lib.utils.load_config(os.path.join(directory, "config.yaml"))
+    sweep_path = os.path.join(directory, lib.utils.SWEEP_RL_FILE)
+    sweep = pd.read_csv(sweep_path) if os.path.exists(sweep_path) else pd.DataFrame()
+
+    models = lib.utils.list_rl_models(directory)
+    files = [models[step] for step in sorted(models)][::every]
+    evaluated = set(sweep["sha256"]) if not sweep.empty else set()
+    hashes = {f: lib.utils.file_hash(os.path.join(directory, f)) for f in files}
+    files = [f for f in files if hashes[f] not in evaluated]
+    print(f"[INFO] {len(files)} checkpoints to evaluate")
+
+    tasks = [
+        (directory, f, hashes[f], config, n_episodes, stages, max_steps) for f in files
+    ]
+    with multiprocessing.get_context("forkserver").Pool(processes) as pool:
+        for stats in pool.imap_unordered(evaluate_checkpoint, tasks):
+            print(f"[INFO] {stats}")
+            sweep = pd.concat([sweep, pd.DataFrame([stats])], ignore_index=True)
+            # rewrite the table after each checkpoint to keep results on a crash
+            sweep.sort_values("step").to_csv(sweep_path, index=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--directory", help="Directory containing the models")
+    parser.add_argument("-e", "--every", type=int, default=1, help="Every Nth model")
+    parser.add_argument("-n", "--episodes", type=int, default=10, help="Episodes")
+    parser.add_argument("-s", "--stages", nargs="+", help="Stages, e.g. 1-1")
+    parser.add_argument("-p", "--processes", type=int, help="Worker processes")
+    parser.add_argument("-m", "--max-steps", type=int, help="Steps per episode")
+    args = parser.parse_args()
+
+    if args.directory is None:
+        raise TypeError("missing 1 positional parameter (-d or --directory)")
+    sweep_rl(
+        args.directory,
+        args.every,
+        args.episodes,
+        args.stages,
+        args.processes,
+        args.max_steps,
+    )
@@ -0,0 +1,22 @@
+""" Check the import time budget of the entry points, see lib.import_budget """
+
+import unittest
+
+from lib.import_budget import IMPORT_BUDGET_MS, import_time
+
+
+class TestImports(unittest.TestCase):
+    """Each entry point imports within its budget, without the heavy modules"""
+
+    def test_import_budget(self):
+        """Import each entry point in a fresh interpreter"""
+        for module, budget in IMPORT_BUDGET_MS.items():
+            with self.subTest(module=module):
+                # the best of 3 runs, for a cold disk cache not to fail the test
+                times, heavy = zip(*(import_time(module) for _ in range(3)))
+                self.assertEqual(heavy[0], [])
+                self.assertLessEqual(min(times), budget)
+
+
+if __name__ == "__main__":
+    unittest.main()
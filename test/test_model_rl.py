@@ -0,0 +1,49 @@
+""" Test the retention policy of the RL checkpoints """
+
+import os
+import tempfile
+import unittest
+
+import lib.utils
+from lib.model_rl import CheckpointWriter
+
+
+class TestCheckpointRetention(unittest.TestCase):
+    """CheckpointWriter keeps the last checkpoints and one per keep_every bucket"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()  # pylint: disable=R1732
+        for step in range(10, 101, 10):
+            with open(os.path.join(self.tmp.name, f"model_{step}.zip"), "wb"):
+                pass
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def prune(self, keep_last: int, keep_every: int) -> list:
+        """Prune the checkpoints and list the steps left"""
+        writer = CheckpointWriter(self.tmp.name, keep_last, keep_every)
+        writer._prune()  # pylint: disable=W0212
+        writer.close()
+        return sorted(lib.utils.list_rl_models(self.tmp.name))
+
+    def test_keep_all(self):
+        """keep_last 0 disables the pruning"""
+        self.assertEqual(self.prune(0, 40), list(range(10, 101, 10)))
+
+    def test_keep_last(self):
+        """Only the last checkpoints are kept without keep_every"""
+        self.assertEqual(self.prune(3, 0), [80, 90, 100])
+
+    def test_keep_every(self):
+        """The first older checkpoint of each keep_every bucket is kept"""
+        self.assertEqual(self.prune(3, 40), [10, 40, 80, 90, 100])
+
+    def test_idempotent(self):
+        """Pruning again does not delete the kept checkpoints"""
+        self.prune(3, 40)
+        self.assertEqual(self.prune(3, 40), [10, 40, 80, 90, 100])
+
+
+if __name__ == "__main__":
+    unittest.main()
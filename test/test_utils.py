@@ -0,0 +1,76 @@
+""" Test the chunked storage of the human runs """
+
+import tempfile
+import unittest
+
+import numpy as np
+
+import lib.utils
+
+
+class TestChunks(unittest.TestCase):
+    """write_chunk, read_chunk and ChunkedStates round trip the steps of a run"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()  # pylint: disable=R1732
+        rng = np.random.default_rng(0)
+        self.states = rng.integers(0, 256, (8, 6, 5, 3), dtype=np.uint8)
+        self.states[4] = self.states[3]  # consecutive frames are often identical
+        self.actions = rng.integers(0, 7, 8)
+        self.lengths = [5, 3]
+        start = 0
+        for index, length in enumerate(self.lengths):
+            stop = start + length
+            lib.utils.write_chunk(
+                self.tmp.name, index, self.states[start:stop], self.actions[start:stop]
+            )
+            start = stop
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def chunked_states(self, cached: int = 1) -> lib.utils.ChunkedStates:
+        """The states of the run, decoded on access"""
+        return lib.utils.ChunkedStates(
+            lib.utils.list_chunks(self.tmp.name), self.lengths, cached
+        )
+
+    def test_read_chunk(self):
+        """The states are decoded from their XOR deltas"""
+        paths = lib.utils.list_chunks(self.tmp.name)
+        self.assertEqual(len(paths), 2)
+        actions, states = lib.utils.read_chunk(paths[0])
+        np.testing.assert_array_equal(actions, self.actions[:5])
+        np.testing.assert_array_equal(states, self.states[:5])
+        actions, states = lib.utils.read_chunk(paths[1], with_states=False)
+        np.testing.assert_array_equal(actions, self.actions[5:])
+        self.assertIsNone(states)
+
+    def test_actions_only(self):
+        """A chunk written without states has none to read"""
+        lib.utils.write_chunk(self.tmp.name, 2, None, self.actions[:2])
+        actions, states = lib.utils.read_chunk(lib.utils.list_chunks(self.tmp.name)[2])
+        np.testing.assert_array_equal(actions, self.actions[:2])
+        self.assertIsNone(states)
+
+    def test_index(self):
+        """Single states are read from the chunk containing them"""
+        states = self.chunked_states()
+        self.assertEqual(len(states), 8)
+        self.assertEqual(states.shape, self.states.shape)
+        for i in [0, 4, 5, 7, -1, -8]:
+            np.testing.assert_array_equal(states[i], self.states[i])
+        with self.assertRaises(IndexError):
+            states[8]  # pylint: disable=W0104
+
+    def test_slice(self):
+        """Slices are assembled across the chunks"""
+        states = self.chunked_states()
+        for key in [slice(0, 8), slice(3, 7), slice(5, 8), slice(2, 4), slice(6, 2)]:
+            np.testing.assert_array_equal(states[key], self.states[key])
+        with self.assertRaises(IndexError):
+            states[::2]  # pylint: disable=W0104
+
+
+if __name__ == "__main__":
+    unittest.main()
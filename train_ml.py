@@ -1,33 +1,71 @@
-""" Train a ML model """
+""" Train a ML model
 
+torch and pandas are imported by the functions using them, see lib.utils.
+"""
+
+from __future__ import annotations
+
+import argparse
+import itertools
+import multiprocessing
 import os
 import random
 import string
+from concurrent.futures import ProcessPoolExecutor
+from typing import TYPE_CHECKING, List
 
 import gym_super_mario_bros.actions
 
-import lib.model_ml
+import lib.env
+import lib.profiling
 import lib.utils
 
+if TYPE_CHECKING:
+    import lib.model_ml
+
+
+def create_model(config: dict, data: lib.utils.HumanData) -> lib.model_ml.PolicyModel:
+    """Create the ML model of a config, fitting the human data
+
+    Args:
+        config : config parameters as a dict
+        data : the human data
+
+    Returns:
+        The model
+    """
+    from lib import model_ml  # pylint: disable=C0415
+
+    height, width, channels = lib.utils.preprocessed_shape(
+        data.frame_shape, config.get("crop_top", 0), config.get("resize", 0)
+    )
+    return model_ml.create_model(
+        config,
+        len(gym_super_mario_bros.actions.SIMPLE_MOVEMENT),
+        (config["stacks"], height, width),
+        in_channels=channels,
+    )
+
 
 def train_ml():
     """Train a ML model on human data"""
+    from lib import model_ml  # pylint: disable=C0415
 
     config = lib.utils.load_config("config_ml.yaml")
     data_path = config["data_path"]
     save_path = config["save_path"]
 
-    actions, states = lib.utils.load_human_data(data_path)
-    train_loader, test_loader = lib.utils.transform_data(actions, states, config)
-
-    model = lib.model_ml.CNNModel(
-        nclasses=len(gym_super_mario_bros.actions.SIMPLE_MOVEMENT),
-        in_channels=states.shape[3],
-    )
+    data = lib.env.load_human_data(data_path)
+    train_loader, test_loader = lib.utils.transform_data(data, config)
 
-    model, metrics = lib.model_ml.learn(model, train_loader, test_loader, config)
+    model = create_model(config, data)
 
     dir_hash = "".join(random.choices(string.ascii_letters + string.digits, k=32))
+    with lib.profiling.profiler_from_config(config, dir_hash) as profiler:
+        model, metrics = model_ml.learn(
+            model, train_loader, test_loader, config, profiler
+        )
+
     save_path = os.path.join(save_path, dir_hash)
     os.makedirs(save_path, exist_ok=False)
 
@@ -36,5 +74,81 @@ def train_ml():
     metrics.to_csv(os.path.join(save_path, "metrics.csv"), index=False)
 
 
+def benchmark_combination(config: dict, n_steps: int) -> dict:
+    """Benchmark the training with the performance options of a config
+
+    Args:
+        config : config parameters as a dict
+        n_steps : number of timed training steps
+
+    Returns:
+        The samples/sec and the peak memory of the training
+    """
+    from lib import model_ml  # pylint: disable=C0415
+
+    data = lib.env.load_human_data(config["data_path"])
+    train_loader, _ = lib.utils.transform_data(data, config)
+    model = create_model(config, data)
+    return model_ml.benchmark(model, train_loader, config, n_steps)
+
+
+def default_threads() -> List[int]:
+    """Get the thread counts benchmarked by default
+
+    Returns:
+        The powers of 2 below the number of cores, and the number of cores
+    """
+    cores = os.cpu_count()
+    return sorted({2**i for i in range(cores.bit_length()) if 2**i < cores} | {cores})
+
+
+def benchmark_ml(n_steps: int, threads: List[int] = None):
+    """Benchmark every combination of precision, memory format, compilation and
+    thread count
+
+    Each combination runs in a fresh process, so that its peak memory is its own.
+
+    Example:
+        python train_ml.py --benchmark=20 --threads 1 4 16
+    """
+    import pandas as pd  # pylint: disable=C0415
+    import torch  # pylint: disable=C0415
+
+    config = lib.utils.load_config("config_ml.yaml")
+    results = []
+    compile_options = [False, True] if hasattr(torch, "compile") else [False]
+    combinations = itertools.product(
+        ["fp32", "bf16"], [False, True], compile_options, threads or default_threads()
+    )
+    for precision, channels_last, compile_model, num_threads in combinations:
+        options = {
+            "precision": precision,
+            "channels_last": channels_last,
+            "compile": compile_model,
+            "num_threads": num_threads,
+        }
+        # not a Pool, whose daemonic workers cannot start DataLoader workers
+        with ProcessPoolExecutor(1, multiprocessing.get_context("spawn")) as pool:
+            result = pool.submit(
+                benchmark_combination, {**config, **options}, n_steps
+            ).result()
+        print(f"[INFO] {options} {result}")
+        results.append({**options, **result})
+
+    print(pd.DataFrame(results).sort_values("samples_per_sec", ascending=False))
+
+
 if __name__ == "__main__":
-    train_ml()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-b", "--benchmark", type=int, help="Benchmark N training steps per setting"
+    )
+    parser.add_argument(
+        "-t", "--threads", type=int, nargs="+", help="Thread counts to benchmark"
+    )
+    args = parser.parse_args()
+
+    if args.benchmark is None:
+        train_ml()
+    else:
+        benchmark_ml(args.benchmark, args.threads)
@@ -1,16 +1,16 @@
 """ Train a RL model """
 
 import lib.env
-import lib.model_rl
 import lib.utils
 
 
 def train_rl():
     """Train a RL model on an env"""
+    from lib import model_rl  # pylint: disable=C0415
 
     config = lib.utils.load_config("config_rl.yaml")
-    env = lib.env.create_stacked_env(config["stacks"])
-    lib.model_rl.learn(config, env)
+    env = lib.env.create_training_env(config)
+    model_rl.learn(config, env)
 
 
 if __name__ == "__main__":
@@ -3,35 +3,69 @@
 import argparse
 import os
 
-from stable_baselines3 import PPO
-
 import lib.env
-import lib.model_rl
+import lib.profiling
 import lib.utils
 
 
 def update_rl(directory: str):
     """Update (continue training) a RL model on an env
 
+    The training resumes from the resume bundle if any, otherwise from the last
+    checkpoint. The bundle being written at the start of a rollout, a training
+    stopped during the update phase can leave it a checkpoint behind: the last
+    checkpoint is then used instead. Only the remaining timesteps of
+    `total_timesteps` are trained. Episodes in progress when the training
+    stopped are restarted, the emulators' state not being saved.
+
     Example:
         python update_rl.py -d="data/models/50bkOHBpXFl2RnGJVImI1MzvI9iXvF26"
     """
+    from lib import model_rl  # pylint: disable=C0415
+
     config = lib.utils.load_config(os.path.join(directory, "config.yaml"))
-    env = lib.env.create_stacked_env(config["stacks"])
+    env = lib.env.create_training_env(config)
 
-    step_model = lib.utils.get_max_step_rl_model(directory)
-    model_path = os.path.join(directory, f"model_{step_model}.zip")
-    model = PPO.load(model_path)
-    model.set_env(env)
+    resume_path = os.path.join(directory, model_rl.RESUME_FILE)
+    step_model = max(lib.utils.list_rl_models(directory), default=0)
+    model = None
+    if os.path.exists(resume_path):
+        model = model_rl.load_resume(resume_path, config["name"], env)
+        if model.num_timesteps < step_model:
+            print(
+                f"[WARNING] The resume bundle of step {model.num_timesteps} is older "
+                f"than the checkpoint of step {step_model}, resuming from the latter"
+            )
+            model = None
+    if model is None:
+        model_path = os.path.join(directory, f"model_{step_model}.zip")
+        model = model_rl.MODELS[config["name"]].load(model_path, env=env)
+        # checkpoints of previous updates were saved with a reset counter
+        model.num_timesteps = step_model
+    # the env is new: start from fresh episodes instead of the saved observation
+    model._last_obs = None  # pylint: disable=W0212
 
     total_timesteps = config["total_timesteps"]
     freq_to_save = config["freq_to_save"]
-    model.learn(
-        total_timesteps=total_timesteps,
-        callback=lib.model_rl.TrainCallback(
-            freq_to_save, directory, n_calls=step_model
-        ),
-    )
+    remaining_timesteps = total_timesteps - model.num_timesteps
+    if remaining_timesteps <= 0:
+        print(f"[INFO] The model is already trained for {model.num_timesteps} steps")
+        return
+    print(f"[INFO] Resuming at step {model.num_timesteps}")
+    profile_name = os.path.basename(os.path.normpath(directory))
+    profile_name += f"_{model.num_timesteps}"
+    with lib.profiling.profiler_from_config(config, profile_name) as profiler:
+        model.learn(
+            total_timesteps=remaining_timesteps,
+            reset_num_timesteps=False,
+            callback=model_rl.TrainCallback(
+                freq_to_save,
+                directory,
+                keep_last=config.get("keep_last", 0),
+                keep_every=config.get("keep_every", 0),
+                profiler=profiler,
+            ),
+        )
 
 
 if __name__ == "__main__":